@@ -15,6 +15,8 @@ def main(args):
     '''Gentoo Cloud Image Builder Utility'''
     import gentooimgr.config
     configjson = gentooimgr.config.determine_config(args)
+    if not args.mirrors:
+        args.mirrors = configjson.get("mirrors") or []
     code = gentooimgr.errorcodes.SUCCESS
     LOG = gentooimgr.logging.LOG
 
@@ -32,7 +34,7 @@ def main(args):
 
     elif args.action == "clean":
         import gentooimgr.clean
-        code = gentooimgr.errorcodes.NOT_IMPLEMENTED
+        code = gentooimgr.clean.clean(args, configjson)
 
     elif args.action == "status":
         import gentooimgr.status
@@ -64,6 +66,10 @@ def main(args):
         import gentooimgr.kernel
         code = gentooimgr.kernel.build_kernel(args, configjson, inchroot=not os.path.exists("/mnt/gentoo"))
 
+    elif args.action == "lock":
+        import gentooimgr.lockfile
+        code = gentooimgr.lockfile.lock(args, configjson)
+
     elif args.action == "step":
         import gentooimgr.steps
         code = gentooimgr.steps.run_step(args, configjson, *args.steps)
@@ -91,7 +97,8 @@ if __name__ == "__main__":
     parser.add_argument("--config-arm", action="store_const", const="arm.json", dest="config",
                         help="Use an ARM qemu configuration")
     parser.add_argument("-y", "--days", type=int, default=gentooimgr.config.DAYS,
-                        help="Number of days before the files are redownloaded")
+                        help="Maximum age in days of cached latest-*.txt and hash files when the mirror cannot be "
+                        "reached to revalidate them")
     parser.add_argument("--use-efi", action="store_const", const="efi", dest="parttype",
                         help="Enable EFI for the resulting gentoo image partition type. If not set, is autodetected.")
     parser.add_argument("--use-mbr", action="store_const", const="mbr", dest="parttype",
@@ -124,6 +131,38 @@ if __name__ == "__main__":
                             help="Extract the specified portage package onto the filesystem")
     parser.add_argument("--stage3", default=None, type=pathlib.Path, nargs='?',
                             help="Extract the specified stage3 package onto the filesystem")
+    parser.add_argument("--template-cache", default=None, type=pathlib.Path,
+                        help="Directory of stage3 rootfs templates. Each stage3 is extracted there once and later "
+                        "installs copy it into the mountpoint (reflinked on btrfs/XFS)")
+    parser.add_argument("--stream-extract", action="store_true",
+                        help="With --install-only or a lockfile, extract stage3 and portage while they download instead "
+                        "of saving them first. Files already in the download directory are extracted as usual")
+    parser.add_argument("--stream-keep", action="store_true",
+                        help="Also save files streamed by --stream-extract to the download directory")
+    parser.add_argument("--portage-squashfs", default=None, type=pathlib.Path,
+                        help="Directory of portage squashfs images. The snapshot is converted there once and mounted "
+                        "read-only (with a tmpfs overlay) at /var/db/repos/gentoo instead of being extracted, so the "
+                        "tree is not part of the image. Needs tar2sqfs or mksquashfs")
+    parser.add_argument("--binpkg-cache", default=None, type=pathlib.Path,
+                        help="Directory of binary packages shared between builds. A subdirectory keyed by architecture, "
+                        "profile, CFLAGS and USE is bind-mounted as the guest's PKGDIR and emerge uses --usepkg --buildpkg")
+    parser.add_argument("--distfiles-cache", default=None, type=pathlib.Path,
+                        help="Host directory bound over the guest's DISTDIR so source tarballs are downloaded once "
+                        "and shared between builds. It is unbound before the install finishes, so the image has none")
+    parser.add_argument("--ccache", default=None, type=pathlib.Path,
+                        help="Host ccache directory mounted into the chroot. Installs ccache, enables FEATURES=ccache "
+                        "and compiles the kernel through it; hit rates are logged at the end of the install")
+    parser.add_argument("--build-times", default=None, type=pathlib.Path,
+                        help="Directory keeping how long each package took to build, for ETAs during install "
+                        "and the slowest packages in status")
+    parser.add_argument("--no-tmpfs", action="store_true",
+                        help="Build packages on the image's disk instead of a tmpfs sized from RAM")
+    parser.add_argument("--kernel-cache", default=None, type=pathlib.Path,
+                        help="Directory of built kernels, installed instead of rebuilt when the sources, .config "
+                        "and toolchain are the same")
+    parser.add_argument("--kernel-clean-build", action="store_true",
+                        help="Remove the kernel build directory after building instead of keeping it for "
+                        "incremental rebuilds of the same configuration")
     parser.add_argument("--kernel-dir", default="/usr/src/linux",
                                help="Where kernel is specified. By default uses the active linux kernel")
     parser.add_argument("--kernel-dist", action="store_true",
@@ -132,6 +171,18 @@ if __name__ == "__main__":
                         help="Downloads files such as stage3 and portage during install phase instead of expecting it at build")
     parser.add_argument("--ignore-collisions", nargs="+",
                         help="A list of paths that emerge will ignore collisions on. Only set if needed.")
+    parser.add_argument("--mirror", action="append", dest="mirrors", default=[],
+                        help="Gentoo mirror base url to download from instead of distfiles.gentoo.org, ie: "
+                        "https://mirror.example.org/gentoo/. May be repeated; the fastest reachable mirror is used "
+                        "first and the others take over on errors. Overrides the \"mirrors\" config list")
+    parser.add_argument("--mirror-cache-hours", type=float, default=24,
+                        help="Hours to reuse the measured mirror ranking before probing the mirrors again")
+    parser.add_argument("--lockfile", type=pathlib.Path, default=None,
+                        help="Lockfile pinning the iso, stage3 and portage files (default: gentooimgr.lock in the "
+                        "download directory). Written by the lock action; build and install use it when it exists")
+    parser.add_argument("--connections", action="append", default=[],
+                        help="Download large files over several connections. Either a number for all mirrors or "
+                        "host=number per mirror; may be repeated, ie: `--connections 2 --connections distfiles.gentoo.org=4`")
     subparsers = parser.add_subparsers(help="gentooimgr actions", dest="action")
     subparsers.required = True
 
@@ -144,6 +195,12 @@ if __name__ == "__main__":
     parser_build.add_argument("--verify", dest="verify", action="store_true", default=True,
                               help="Verify downloaded iso")
     parser_build.add_argument("--redownload", action="store_true", help="Overwrite downloaded files")
+    parser_build.add_argument("--verify-deep", action="store_true",
+                              help="Rehash downloaded files even if they are unchanged since their last verification")
+    parser_build.add_argument("--parallel", action="store_true",
+                              help="Download the iso, stage3 and portage files at the same time")
+    parser_build.add_argument("--fetch-jobs", type=int, default=3,
+                              help="Maximum number of concurrent downloads when using --parallel (default: 3)")
     parser_run = subparsers.add_parser('run', help="Run a Gentoo Image in QEMU")
 
     # Although not explicitly stated, if image is None and --iso is not defined, the gentoo
@@ -162,13 +219,21 @@ if __name__ == "__main__":
                             help="Memory (in MB) to use in run action. Takes presidence over config file if > 0.")
     parser_test = subparsers.add_parser('test', help="Test whether image is a legitamite cloud configured image")
 
-    parser_clean = subparsers.add_parser('clean', help="Remove all downloaded files")
-    # --force also applies to clean action
+    parser_clean = subparsers.add_parser('clean', help="Remove downloaded files, least recently used first. "
+                                         "Files used by the config or lockfile are kept unless --force is set")
+    parser_clean.add_argument("--budget", type=str, default=None,
+                              help="Keep up to this much (ie: 20G) in the download dir, removing least recently used "
+                              "files beyond it. Without it or --max-age all unused files are removed")
+    parser_clean.add_argument("--max-age", type=float, default=None,
+                              help="Also remove files not used for this many days, even within --budget")
+    # --force also applies to clean action, --pretend only reports what would be freed
 
     parser_step = subparsers.add_parser('step', help="Invoke an individual step")
     parser_step.add_argument("steps", nargs="+", default=(), type=int, help=f"Steps 0-{LAST_STEP}")
     parser_step.add_argument("--rsync-repo", nargs="?", help="Set the gentoo rsync repo to this address (server name or ip address, ie: 192.168.1.50). Useful for testing / not spamming emerge repos. Applies to step 7 in particular.")
     parser_status = subparsers.add_parser('status', help="Review information, downloaded images and configurations")
+    parser_status.add_argument("--kernel-diff", default=None,
+                               help="Show the kernel options that differ from this .config (path or name in configs/)")
 
     parser_install = subparsers.add_parser("install", help="Install Gentoo on a qemu guest. Defaults to "
                                            "--config-base with --kernel-dist if the respective --config or --kernel options are not provided.")
@@ -207,8 +272,15 @@ if __name__ == "__main__":
                                " to qcow2 and then it will compress the result.")
     parser_shrink.add_argument("--only-convert", action="store_true",
                                help="Convert and exit, do not attempt to shrink the image.")
+    parser_lock = subparsers.add_parser('lock', help="Download the latest iso, stage3 and portage and pin them in a lockfile "
+                                        "so later build/install actions use exactly these files without looking up new ones")
+    parser_lock.add_argument("--redownload", action="store_true", help="Overwrite downloaded files")
+    parser_lock.add_argument("--verify-deep", action="store_true",
+                             help="Rehash downloaded files even if they are unchanged since their last verification")
     parser_kernel = subparsers.add_parser('kernel', help="Build the kernel based on configuration and optional --kernel-dist flag.")
     parser_kernel.add_argument("--kconf", nargs="?", help="Specify which kernel configuration file to build with")
+    parser_kernel.add_argument("--trim", action="store_true",
+                               help="Disable the drivers and file systems a virtio guest does not use before building")
 
     args = parser.parse_args()
     gentooimgr.logging.set_logger(args)  # Pulls out logging parameters to configure logging for any process.
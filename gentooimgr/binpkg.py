@@ -0,0 +1,98 @@
+"""Shared binary package cache for the emerge steps
+
+With --binpkg-cache DIR, a subdirectory of DIR is bind-mounted over the guest's PKGDIR before
+chrooting and every emerge runs with --usepkg --buildpkg, so packages built once are installed
+from binaries by later builds. The subdirectory is keyed by everything that changes what a
+binary package contains: architecture, profile, CHOST, CFLAGS, CXXFLAGS and USE from the
+guest's make.conf. Builds with a different key get a cache of their own.
+
+Hits and misses are counted from the "Merging Binary" and "Compiling/Merging" lines emerge
+writes to /var/log/emerge.log.
+"""
+
+import os
+import re
+import json
+import hashlib
+import gentooimgr.common
+from gentooimgr.process import run_cmd
+from gentooimgr.logging import LOG
+
+DEFAULT_PKGDIR = "/var/cache/binpkgs"
+EMERGE_LOG = "/var/log/emerge.log"
+# make.conf variables that are part of the cache key
+KEY_VARIABLES = ("CHOST", "CFLAGS", "CXXFLAGS", "USE")
+BINARY_RE = re.compile(r"=== \(\d+ of \d+\) Merging Binary \((\S+?)::")
+SOURCE_RE = re.compile(r"=== \(\d+ of \d+\) Compiling/Merging \((\S+?)::")
+
+# Size of the emerge log when the cache was mounted, so only this build is counted
+_log_offset = None
+
+
+def cache_key(cfg: dict, mountpoint: str) -> dict:
+    """Returns the values that select the binary package cache of this build"""
+    values = gentooimgr.common.make_conf(mountpoint)
+    profile = os.path.join(mountpoint, "etc", "portage", "make.profile")
+    key = {
+        "architecture": cfg.get("architecture"),
+        "profile": os.readlink(profile).split("profiles/", 1)[-1] if os.path.islink(profile) else None
+    }
+    key.update({name: " ".join(values.get(name, "").split()) for name in KEY_VARIABLES})
+    return key
+
+
+def cache_dir(cache: str, key: dict) -> str:
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+    return os.path.join(str(cache), f"{key['architecture']}-{digest}")
+
+
+def mount(args, cfg: dict) -> int:
+    """Bind the cache for this configuration over the guest's PKGDIR"""
+    global _log_offset
+    mountpoint = cfg.get("mountpoint")
+    key = cache_key(cfg, mountpoint)
+    pkgdir = cache_dir(args.binpkg_cache, key)
+    target = os.path.join(mountpoint, gentooimgr.common.make_conf(mountpoint).get("PKGDIR", DEFAULT_PKGDIR).lstrip(os.sep))
+    if not args.pretend:
+        os.makedirs(pkgdir, exist_ok=True)
+        os.makedirs(target, exist_ok=True)
+        with open(os.path.join(pkgdir, "key.json"), 'w') as f:
+            json.dump(key, f, indent=4, sort_keys=True)
+    code, out, err = run_cmd(args, ["mount", "--bind", pkgdir, target])
+    if code:
+        LOG.error(f"\t:: Unable to bind binary package cache {pkgdir}")
+        return code
+    log = os.path.join(mountpoint, EMERGE_LOG.lstrip(os.sep))
+    _log_offset = os.path.getsize(log) if os.path.exists(log) else 0
+    LOG.info(f"\t:: Using binary package cache {pkgdir} ({count(pkgdir)} packages)")
+    return 0
+
+
+def count(pkgdir: str) -> int:
+    """Number of binary packages (.tbz2 or .gpkg.tar) in pkgdir"""
+    found = 0
+    for root, dirs, files in os.walk(pkgdir):
+        found += sum(1 for f in files if f.endswith((".tbz2", ".gpkg.tar", ".xpak")))
+    return found
+
+
+def emerge_options(args) -> list:
+    """Options added to every emerge when the cache is enabled"""
+    return ["--usepkg", "--buildpkg"] if getattr(args, "binpkg_cache", None) else []
+
+
+def report(args) -> tuple:
+    """Log and return (hits, misses) of the packages merged since the cache was mounted.
+
+    Runs inside the chroot, so the emerge log is read from its chroot path.
+    """
+    if not getattr(args, "binpkg_cache", None) or not os.path.exists(EMERGE_LOG):
+        return (0, 0)
+    with open(EMERGE_LOG, 'r', errors="replace") as f:
+        f.seek(_log_offset or 0)
+        content = f.read()
+    hits, misses = BINARY_RE.findall(content), SOURCE_RE.findall(content)
+    LOG.info(f"\t:: Binary package cache: {len(hits)} hits, {len(misses)} misses (built from source)")
+    if misses:
+        LOG.debug(f"\t:: Built from source: {' '.join(misses)}")
+    return (len(hits), len(misses))
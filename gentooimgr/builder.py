@@ -1,17 +1,75 @@
 import os
 import argparse
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
 import gentooimgr.config
 import gentooimgr.download as download
+import gentooimgr.lockfile
 import gentooimgr.qemu as qemu
 import gentooimgr.common
 import gentooimgr.errorcodes
 from gentooimgr.logging import LOG
 
+def fetchers(args: argparse.Namespace, config: dict, c) -> dict:
+    """Returns a dict of component name to a callable(progress) that downloads it and returns its path.
+
+    Components already set in the configuration are left out. With a lockfile, the pinned artifacts
+    are used and no latest-*.txt lookups are done.
+    """
+    locked = gentooimgr.lockfile.load(args, config)
+    jobs = {}
+    for name in gentooimgr.lockfile.COMPONENTS:
+        if config.get(name):
+            continue
+        if locked:
+            jobs[name] = lambda progress, entry=locked[name]: gentooimgr.lockfile.resolve(args, entry, progress=progress)
+        elif name == "iso":
+            jobs[name] = lambda progress: download.download(args, c, progress=progress)
+        elif name == "stage3":
+            jobs[name] = lambda progress: download.download_stage3(args, cfg=config, progress=progress)
+        else:
+            jobs[name] = lambda progress: download.download_portage(args, progress=progress)
+    return jobs
+
+def fetch_parallel(args: argparse.Namespace, config: dict, c) -> dict:
+    """Download iso, stage3 and portage at the same time on a bounded thread pool.
+
+    Components already set in the configuration are not downloaded. All transfers share one
+    CombinedProgress line. The first download or verification failure cancels the remaining
+    transfers and is re-raised.
+
+    :Returns:
+        dict of component name to the full path of the downloaded file
+    """
+    progress = download.CombinedProgress()
+    jobs = fetchers(args, config, c)
+
+    results = {name: config.get(name) for name in gentooimgr.lockfile.COMPONENTS}
+    with ThreadPoolExecutor(max_workers=max(1, args.fetch_jobs)) as pool:
+        futures = {pool.submit(func, progress.hook(name)): name for name, func in jobs.items()}
+        done, pending = wait(futures, return_when=FIRST_EXCEPTION)
+        failed = [f for f in done if f.exception() is not None]
+        if failed:
+            progress.cancel()
+            for f in pending:
+                f.cancel()
+            wait(pending)
+            progress.finish()
+            LOG.error(f"\t:: Download of {futures[failed[0]]} failed, cancelled remaining downloads")
+            raise failed[0].exception()
+
+    progress.finish()
+    for f, name in futures.items():
+        results[name] = f.result()
+    return results
+
 def build(args: argparse.Namespace, config: dict) -> int:
     c = gentooimgr.config.config(config.get("architecture"))
-    iso = config.get("iso") or download.download(args, c)
-    stage3 = config.get("stage3") or download.download_stage3(args)
-    portage = config.get("portage") or download.download_portage(args)
+    if getattr(args, "parallel", False):
+        fetched = fetch_parallel(args, config, c)
+    else:
+        fetched = {name: config.get(name) for name in gentooimgr.lockfile.COMPONENTS}
+        fetched.update({name: func(None) for name, func in fetchers(args, config, c).items()})
+    iso, stage3, portage = fetched["iso"], fetched["stage3"], fetched["portage"]
     filename = f"{args.image}.{args.format}"
     image, code = qemu.create_image(args, config)
     if not os.path.exists(image):
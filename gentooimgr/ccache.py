@@ -0,0 +1,107 @@
+"""Compiler cache for emerge and kernel builds
+
+With --ccache DIR, DIR is bind-mounted at /var/cache/ccache in the chroot. dev-util/ccache is
+installed before the first emerge of step 9, after which every emerge runs with FEATURES=ccache
+and kernel builds compile with `ccache gcc`. Packages and kernels that were compiled before by any
+build sharing DIR come out of the cache.
+
+The ccache statistics are saved when the cache is enabled and the difference is logged at the end of
+the install. Builds running at the same time on the same DIR count towards each other's figures.
+"""
+
+import os
+import json
+import shutil
+import gentooimgr.chroot
+from gentooimgr.process import run, run_cmd
+from gentooimgr.logging import LOG
+
+CCACHE_DIR = "/var/cache/ccache"
+CCACHE_PACKAGE = "dev-util/ccache"
+# Only written if DIR has no ccache.conf yet, so users can change it
+DEFAULT_CONF = "max_size = 20G\numask = 002\ncompiler_check = content\n"
+# ccache statistics when the cache was enabled, in the chroot's /tmp like the .step files
+STATS_FILE = "/tmp/gentooimgr-ccache.json"
+HIT_STATS = ("direct_cache_hit", "preprocessed_cache_hit")
+MISS_STATS = ("cache_miss",)
+
+
+def enabled(args) -> bool:
+    return bool(getattr(args, "ccache", None))
+
+
+def mount(args, cfg: dict) -> int:
+    """Bind DIR at CCACHE_DIR in the mountpoint, writable by the guest's portage user"""
+    mountpoint = cfg.get("mountpoint")
+    target = os.path.join(mountpoint, CCACHE_DIR.lstrip(os.sep))
+    if not args.pretend:
+        os.makedirs(args.ccache, exist_ok=True)
+        os.makedirs(target, exist_ok=True)
+        os.chown(args.ccache, *gentooimgr.chroot.portage_ids(mountpoint))
+        os.chmod(args.ccache, 0o2775)
+        conf = os.path.join(args.ccache, "ccache.conf")
+        if not os.path.exists(conf):
+            with open(conf, 'w') as f:
+                f.write(DEFAULT_CONF)
+    code, out, err = run_cmd(args, ["mount", "--bind", str(args.ccache), target])
+    if code:
+        LOG.error(f"\t:: Unable to bind ccache directory {args.ccache}")
+    return code
+
+
+def install(args) -> None:
+    """Install ccache in the chroot if it is missing, then enable it"""
+    if not enabled(args):
+        return
+    if not shutil.which("ccache"):
+        LOG.info("\t:: Installing ccache")
+        run_cmd(args, ["emerge", "--oneshot", "--noreplace", CCACHE_PACKAGE])
+    if not args.pretend:
+        enable(args)
+
+
+def enable(args) -> bool:
+    """Set FEATURES=ccache and CCACHE_DIR for emerge and kernel builds, if ccache is installed in the chroot"""
+    if not enabled(args) or not shutil.which("ccache"):
+        return False
+    features = os.environ.get("FEATURES", "").split()
+    if "ccache" not in features:
+        os.environ["FEATURES"] = " ".join(features + ["ccache"])
+    os.environ["CCACHE_DIR"] = CCACHE_DIR
+    if not os.path.exists(STATS_FILE):
+        with open(STATS_FILE, 'w') as f:
+            json.dump(stats(), f)
+    return True
+
+
+def compiler(args) -> str:
+    """Returns the C compiler command for kernel builds, or None when ccache is not enabled"""
+    if enabled(args) and shutil.which("ccache"):
+        return "ccache gcc"
+    return None
+
+
+def stats() -> dict:
+    """Returns the counters of `ccache --print-stats`"""
+    code, out, err = run(["ccache", "--print-stats"])
+    counters = {}
+    for line in (out or b"").decode().splitlines():
+        name, _, value = line.partition("\t")
+        if value.strip().isdigit():
+            counters[name] = int(value)
+    return counters
+
+
+def report(args) -> tuple:
+    """Log and return (hits, misses) of this build"""
+    if not enabled(args) or not shutil.which("ccache") or not os.path.exists(STATS_FILE):
+        return (0, 0)
+    with open(STATS_FILE, 'r') as f:
+        before = json.load(f)
+    after = stats()
+    hits = sum(after.get(name, 0) - before.get(name, 0) for name in HIT_STATS)
+    misses = sum(after.get(name, 0) - before.get(name, 0) for name in MISS_STATS)
+    rate = 100 * hits / (hits + misses) if hits + misses else 0
+    LOG.info(f"\t:: ccache: {hits} hits, {misses} misses ({rate:.1f}% hit rate), "
+             f"{after.get('cache_size_kibibyte', 0) >> 20} GiB cached")
+    return (hits, misses)
@@ -2,10 +2,37 @@ import os
 import sys
 from subprocess import Popen, PIPE
 import gentooimgr.config
+import gentooimgr.common
 from gentooimgr.logging import LOG
 import gentooimgr.errorcodes
 
-def bind(mount=gentooimgr.config.GENTOO_MOUNT, verbose=True):
+DEFAULT_DISTDIR = "/var/cache/distfiles"
+
+def distdir(mount=gentooimgr.config.GENTOO_MOUNT):
+    """Path of the guest's DISTDIR under mount"""
+    return os.path.join(mount, gentooimgr.common.make_conf(mount).get("DISTDIR", DEFAULT_DISTDIR).lstrip(os.sep))
+
+
+def portage_ids(mount=gentooimgr.config.GENTOO_MOUNT):
+    """uid and gid of the portage user in the guest, which emerge fetches as"""
+    uid = gid = 250
+    passwd = os.path.join(mount, "etc", "passwd")
+    if os.path.exists(passwd):
+        with open(passwd, 'r') as f:
+            for line in f:
+                fields = line.split(":")
+                if fields[0] == "portage" and len(fields) > 3:
+                    uid, gid = int(fields[2]), int(fields[3])
+    return uid, gid
+
+
+def bind(mount=gentooimgr.config.GENTOO_MOUNT, verbose=True, distfiles=None):
+    """Bind mount the host filesystems the chroot needs.
+
+    distfiles is an optional host directory bound over the guest's DISTDIR so source tarballs are
+    downloaded once and shared by every build. Concurrent builds fetching the same file wait on each
+    other through portage's distlocks, which keeps its lock files in the shared directory.
+    """
     mounts = [
         ["mount", "--types", "proc", "/proc", os.path.join(mount, "proc")],
         ["mount", "--rbind", "/sys", os.path.join(mount, "sys")],
@@ -15,6 +42,17 @@ def bind(mount=gentooimgr.config.GENTOO_MOUNT, verbose=True):
         ["mount", "--bind", "/run", os.path.join(mount, "run")],
         ["mount", "--make-slave", os.path.join(mount, "run")],
     ]
+    if distfiles:
+        target = distdir(mount)
+        os.makedirs(distfiles, exist_ok=True)
+        os.makedirs(target, exist_ok=True)
+        # Writable by the guest's portage user, files created there keep the group
+        os.chown(distfiles, *portage_ids(mount))
+        os.chmod(distfiles, 0o2775)
+        mounts.append(["mount", "--bind", str(distfiles), target])
+        features = os.environ.get("FEATURES", "").split()
+        if "distlocks" not in features:
+            os.environ["FEATURES"] = " ".join(features + ["distlocks"])
     code = gentooimgr.errorcodes.SUCCESS
     for mcmd in mounts:
         if verbose:
@@ -49,6 +87,9 @@ def unbind(mount=gentooimgr.config.GENTOO_MOUNT, verbose=True):
         ["umount", "-l", os.path.join(mount, 'dev')],
         ["umount", "-R", mount]
     ]
+    if os.path.ismount(distdir(mount)):
+        # Shared distfiles go first so nothing below writes into the image's own DISTDIR
+        unmounts.insert(0, ["umount", distdir(mount)])
     code = gentooimgr.errorcodes.SUCCESS
     for uncmd in unmounts:
         if verbose:
@@ -75,3 +116,20 @@ def chroot(path=gentooimgr.config.GENTOO_MOUNT, shell="/bin/bash") -> int:
 
 def unchroot(path=gentooimgr.config.GENTOO_MOUNT) -> int:
     return unbind(mount=path)
+
+
+def unbind_distfiles(mount=os.sep):
+    """Remove the shared distfiles bind so the image does not carry the source tarballs.
+
+    The default mount is for calling this from inside the chroot.
+    """
+    target = distdir(mount)
+    if not os.path.ismount(target):
+        return gentooimgr.errorcodes.SUCCESS
+    proc = Popen(["umount", target], stdout=PIPE, stderr=PIPE)
+    stdout, stderr = proc.communicate()
+    if proc.returncode != 0:
+        LOG.error(f"Unable to unmount {target}\n\tstderr: {stderr}")
+        return gentooimgr.errorcodes.PROCESS_FAILED
+    LOG.info(f"\t:: Removed shared distfiles bind {target}")
+    return gentooimgr.errorcodes.SUCCESS
@@ -0,0 +1,154 @@
+"""Remove downloaded and generated files from the download directory
+
+Files are evicted least recently used first (by the later of their access and modification time):
+anything unused for longer than --max-age days goes first, then the oldest files until the rest fits
+in --budget. With only --max-age, only the expired files are removed; with neither option every
+unprotected file is. Files referenced by the active configuration, --iso/--stage3/--portage or the
+lockfile are kept unless --force is set. Files of an artifact a running build holds the
+download.artifact_lock() of are skipped, and lock files are never removed.
+"""
+
+import os
+import re
+import time
+import fcntl
+import gentooimgr.config
+import gentooimgr.download
+import gentooimgr.lockfile
+import gentooimgr.errorcodes
+from gentooimgr.logging import LOG
+
+# Files in the download directory that clean may remove
+CLEANABLE_RE = re.compile(
+    r"^(install-.*\.iso|stage3-.*\.tar\.[^.]+|portage-.*\.tar\.[^.]+|latest-.*\.txt|gentooimgr\.iso|converted-.*?)"
+    r"(\.sha256|\.sha512|\.DIGESTS|\.md5sum|\.part|\.part\.segments|\.part\.validator)?$"
+)
+SIZE_SUFFIXES = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_size(size: str) -> int:
+    """Converts a size such as 512M or 20G (same suffixes as --size) to bytes"""
+    m = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$", str(size), re.IGNORECASE)
+    if m is None:
+        raise ValueError(f"Invalid size {size}")
+    return int(float(m.group(1)) * SIZE_SUFFIXES[m.group(2).upper()])
+
+
+def artifact_name(name: str) -> str:
+    """Name of the artifact a cleanable file belongs to, without its hash file or partial download suffix"""
+    m = CLEANABLE_RE.match(name)
+    return m.group(1) if m else name
+
+
+def protected_names(args, config: dict) -> set:
+    """Names of artifacts that are in use by the configuration, command line or lockfile.
+
+    This includes the latest-*.txt files the configuration resolves the iso and stage3 through, and
+    the files they currently name.
+    """
+    names = set()
+    c = gentooimgr.config.config(config.get("architecture", "amd64"))
+    s3c = gentooimgr.download.stage3_config(config)
+    systemd = gentooimgr.download.stage3_profile(args, config) == "systemd"
+    latest = ((c.GENTOO_LATEST_ISO_FILE, gentooimgr.download.parse_latest_iso_text),
+              (s3c.GENTOO_LATEST_STAGE_SYSTEMD_FILE if systemd else s3c.GENTOO_LATEST_STAGE_OPENRC_FILE,
+               gentooimgr.download.parse_latest_stage3_text))
+    for txt, parse in latest:
+        names.add(txt)
+        path = os.path.join(args.download_dir, txt)
+        if os.path.exists(path):
+            names.add(parse(path)[1])
+    for value in (config.get("iso"), config.get("stage3"), config.get("portage"), config.get("imagename"),
+                  getattr(args, "stage3", None), getattr(args, "portage", None), getattr(args, "iso", None)):
+        if value:
+            names.add(os.path.basename(str(value)))
+    locked = gentooimgr.lockfile.load(args)
+    if locked:
+        names.update(locked[name]["name"] for name in gentooimgr.lockfile.COMPONENTS if name in locked)
+    names.discard(None)
+    return names
+
+
+def scan(download_dir) -> list:
+    """Returns a list of (last used time, size, path) for every cleanable file in download_dir"""
+    found = []
+    with os.scandir(download_dir) as entries:
+        for entry in entries:
+            if not CLEANABLE_RE.match(entry.name) or not entry.is_file(follow_symlinks=False):
+                continue
+            st = entry.stat(follow_symlinks=False)
+            found.append((max(st.st_atime, st.st_mtime), st.st_size, entry.path))
+    return found
+
+
+def select(files: list, protected: set, budget: int = None, max_age: float = None, now: float = None) -> list:
+    """Returns the (last used, size, path) entries to evict, least recently used first.
+
+    Files of a protected artifact (see artifact_name()) are never evicted. Files are evicted for size only when there is a budget, or when there is no max_age either.
+    """
+    now = time.time() if now is None else now
+    if budget is None and max_age is None:
+        budget = 0
+    candidates = sorted(f for f in files if artifact_name(os.path.basename(f[2])) not in protected)
+    total = sum(size for used, size, path in files)
+    evict = []
+    for used, size, path in candidates:
+        expired = max_age is not None and now - used > max_age * gentooimgr.config.DAY_IN_SECONDS
+        if expired or (budget is not None and total > budget):
+            evict.append((used, size, path))
+            total -= size
+    return evict
+
+
+def _lock_nowait(base: str, create: bool = True):
+    """Take the artifact_lock() flock of base without waiting. Returns the fd holding it, False if
+    another process holds it, or None if there is no lock file to take."""
+    try:
+        fd = os.open(base + ".lock", os.O_RDWR | (os.O_CREAT if create else 0), 0o644)
+    except OSError:
+        return None
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return False
+    return fd
+
+
+def clean(args, config: dict) -> int:
+    protected = set() if args.force else protected_names(args, config)
+    files = scan(args.download_dir)
+    budget = parse_size(args.budget) if args.budget else None
+    evict = select(files, protected, budget=budget, max_age=args.max_age)
+
+    freed = 0
+    removed = 0
+    # Locks are held until every file of their artifact is removed, so no build starts on it meanwhile
+    locks = {}
+    try:
+        for used, size, path in evict:
+            base = os.path.join(os.path.dirname(path), artifact_name(os.path.basename(path)))
+            if base not in locks:
+                locks[base] = _lock_nowait(base, create=not args.pretend)
+            if locks[base] is False:
+                LOG.info(f"\t:: Skipping {path}, a running build is using it")
+                continue
+            age = (time.time() - used) / gentooimgr.config.DAY_IN_SECONDS
+            if args.pretend:
+                LOG.info(f"PRETEND remove {path} ({size} bytes, last used {age:.1f} days ago)")
+            else:
+                LOG.info(f"\t:: Removing {path} ({size} bytes, last used {age:.1f} days ago)")
+                os.remove(path)
+            freed += size
+            removed += 1
+    finally:
+        for fd in locks.values():
+            if fd not in (None, False):
+                os.close(fd)
+
+    if not args.pretend:
+        gentooimgr.download.prune_index(args.download_dir)
+    kept = sum(size for used, size, path in files) - freed
+    print(f"{'Would free' if args.pretend else 'Freed'} {freed >> 20} MiB in {removed} files, "
+          f"{kept >> 20} MiB kept ({len(protected)} protected)")
+    return gentooimgr.errorcodes.SUCCESS
@@ -1,4 +1,5 @@
 import os
+import re
 import sys
 import time
 import copy
@@ -24,6 +25,49 @@ def older_than_days_specified(fullpath):
     return time.time() - filetime > gentooimgr.config.DAY_IN_SECONDS * gentooimgr.config.DAYS
 
 
+MAKE_CONF_RE = re.compile(r'^\s*([A-Z_]+)\s*=\s*"([^"]*)"', re.MULTILINE)
+PF_RE = re.compile(r"^(?P<pn>.+?)-(?P<version>\d[^-]*(?:-r\d+)?)$")
+
+def split_cpv(cpv):
+    """Returns (category/package, version) of category/package-version, version None if it has none"""
+    category, _, pf = cpv.rpartition("/")
+    m = PF_RE.match(pf)
+    pn, version = (m.group("pn"), m.group("version")) if m else (pf, None)
+    return (f"{category}/{pn}" if category else pn, version)
+
+def make_conf(mountpoint):
+    """Returns the quoted variable assignments of the make.conf under mountpoint"""
+    values = {}
+    for path in (os.path.join(mountpoint, "etc", "portage", "make.conf"), os.path.join(mountpoint, "etc", "make.conf")):
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                content = f.read()
+            for name, value in MAKE_CONF_RE.findall(content):
+                # Expand references to earlier variables, ie: CXXFLAGS="${COMMON_FLAGS}"
+                values[name] = re.sub(r"\$\{?(\w+)\}?", lambda m: values.get(m.group(1), ""), value)
+            break
+    return values
+
+
+def fstab_entries(args, config):
+    """Returns the (device, mountpoint, type, options, dump, pass) lines of the guest's fstab"""
+    entries = []
+    partition = 1
+    if args.parttype == "efi":
+        entries.append((f"{config.get('disk')}{partition}", "/boot", "vfat", "noatime", 1, 2))
+        partition += 1
+
+    if args.new_world_mac:
+        partition = config.get("partition_start", 3)
+        entries.append((f"{config.get('disk')}{partition}", "/boot", "ext2", "noatime", 1, 2))
+        partition += 1
+        entries.append((f"{config.get('disk')}{partition}", "none", "swap", "sw", 0, 0))
+        partition += 1
+
+    entries.append((f"{config.get('disk')}{partition}", "/", "ext4", "defaults,noatime", 0, 1))
+    return entries
+
+
 def find_iso(download_dir):
     name = None
     ext = None
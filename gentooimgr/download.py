@@ -1,15 +1,32 @@
 """Module to handle downloading and verification of Gentoo images
 
-To ensure accuracy, we re-download every .txt file if it's older than one day.
+To ensure accuracy, every .txt and hash file is revalidated with the mirror on each run using
+a conditional request, so an unchanged file costs a 304 response and a new release is noticed
+immediately. --days only limits how stale a cached file may be when the mirror is unreachable.
 We assume that people building a cloud configured image want what is most up to date.
 If you have a specific image you want built over and over regardless, create a config
 file and load it in using -c/--config that points GENTOO_* values to the files you want.
+
+Files are downloaded to a [name].part file and only renamed to their final name once their
+size and hash have been confirmed, so a file that exists under its real name is always complete.
+An interrupted download is resumed from its .part file with an HTTP Range request.
+
+Several gentooimgr processes can share one download directory: each artifact is downloaded while
+holding an exclusive lock on [name].lock, and other processes wanting it wait for that download
+instead of starting their own.
 """
 
 import os
 import re
 import sys
+import json
+import time
+import fcntl
+import threading
+import contextlib
 from datetime import date
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
 import hashlib
 from gentooimgr.logging import LOG
 try:
@@ -17,9 +34,11 @@ try:
 except ImportError as iE:
     LOG.error("Missing import: progressbar")
 
-from urllib.request import urlretrieve
+from urllib.request import urlopen, Request
+from urllib.error import HTTPError, URLError
 import tempfile
 import gentooimgr.config
+import gentooimgr.mirrors
 from gentooimgr.common import older_than_a_day
 
 hashpattern =    re.compile(gentooimgr.config.GENTOO_FILE_HASH_RE, re.MULTILINE)
@@ -28,6 +47,19 @@ isohashpattern = re.compile(gentooimgr.config.GENTOO_FILE_ISO_HASH_RE, re.MULTIL
 stage3pattern  = re.compile(gentooimgr.config.GENTOO_FILE_STAGE3_RE, re.MULTILINE)
 stage3hashpattern = re.compile(gentooimgr.config.GENTOO_FILE_STAGE3_HASH_RE, re.MULTILINE)
 
+# Bytes read from the socket and written to the .part file at a time
+CHUNK_SIZE = 1024 * 1024
+# Seconds to wait on a stalled connection before giving up
+TIMEOUT = 60
+# Byte range fetched by each request of a segmented download, and the smallest file worth splitting
+SEGMENT_SIZE = 32 * 1024 * 1024
+SEGMENT_MIN_FILESIZE = 2 * SEGMENT_SIZE
+# Records digests of verified files in the download directory so unchanged files aren't rehashed
+VERIFIED_INDEX = ".gentooimgr-verified.json"
+# ETag/Last-Modified of each metadata url (latest-*.txt, hash files) for conditional requests
+VALIDATOR_CACHE = ".gentooimgr-validators.json"
+_index_lock = threading.Lock()
+
 class DownloadProgressBar():
     def __init__(self):
         self.progress = None
@@ -47,6 +79,495 @@ class DownloadProgressBar():
         except NameError as nE:
             LOG.warn("Unable to use progressbar to show progress")
 
+def announce(text: str, progress=None) -> None:
+    """Print text, above the CombinedProgress line when progress is one of its hooks"""
+    combined = getattr(progress, "combined", None)
+    if combined is not None:
+        combined.write(text)
+    else:
+        print(text)
+
+class DownloadCancelled(Exception):
+    """Raised from a progress hook to abort a transfer, ie: when a sibling download failed"""
+
+class CombinedProgress():
+    """Single progress line for several concurrent downloads.
+
+    Each download gets its own urlretrieve-style hook from hook(name); totals are summed
+    as they become known so the line shows overall bytes and percentage. Calling cancel()
+    makes every hook raise DownloadCancelled on its next block so in-flight transfers stop.
+    Messages go through write() (or announce() given a hook) so they don't garble the line.
+    """
+    def __init__(self, stream=sys.stdout, interval=0.5):
+        self.stream = stream
+        self.interval = interval
+        self.transfers = {}
+        self.cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._last = 0
+        self._width = 0
+
+    def hook(self, name):
+        def _hook(block_num, block_size, total_size):
+            if self.cancelled.is_set():
+                raise DownloadCancelled(name)
+            with self._lock:
+                total = max(total_size, 0)
+                self.transfers[name] = (min(block_num * block_size, total) if total else block_num * block_size, total)
+                self._render()
+        _hook.combined = self
+        return _hook
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def _render(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._last < self.interval:
+            return
+        self._last = now
+        done = sum(d for d, t in self.transfers.values())
+        total = sum(t for d, t in self.transfers.values())
+        names = ' '.join(f"{n}:{int(d * 100 / t) if t else 0}%" for n, (d, t) in sorted(self.transfers.items()))
+        percent = f"{done * 100 / total:5.1f}%" if total else "  ?  "
+        line = f"{percent} {done >> 20}/{total >> 20} MiB [{names}]"
+        self.stream.write(f"\r{line}{' ' * (self._width - len(line))}")
+        self.stream.flush()
+        self._width = len(line)
+
+    def write(self, text):
+        """Print text on its own line and redraw the progress line below it"""
+        with self._lock:
+            self.stream.write(f"\r{text}{' ' * (self._width - len(text))}\n")
+            self._width = 0
+            if self.transfers:
+                self._render(force=True)
+            self.stream.flush()
+
+    def finish(self):
+        with self._lock:
+            self._render(force=True)
+            self.stream.write("\n")
+            self.stream.flush()
+
+@contextlib.contextmanager
+def artifact_lock(fullpath: str, verbose: bool = True):
+    """Hold an exclusive flock on fullpath.lock for the duration of the block.
+
+    If another process (or thread) holds it, this logs who is being waited on and blocks until
+    the lock is released. Yields True if it had to wait, in which case the caller should check
+    whether fullpath was published in the meantime. On a read-only download directory no lock
+    can be created, so the block runs unlocked.
+    """
+    try:
+        fd = os.open(fullpath + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+    except OSError as E:
+        LOG.debug(f"\t:: Unable to lock {fullpath}: {E}")
+        yield False
+        return
+
+    waited = False
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            holder = os.pread(fd, 64, 0).decode(errors="replace").strip() or "another process"
+            (LOG.info if verbose else LOG.debug)(f"\t:: Waiting for {holder} to finish with {os.path.basename(fullpath)}")
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            waited = True
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, f"pid {os.getpid()}".encode(), 0)
+        yield waited
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+class DownloadError(Exception):
+    """Raised when a transfer cannot produce a complete file"""
+
+class RangeNotSupported(DownloadError):
+    """Raised by fetch_segmented() when the server answers a range request with the whole file"""
+
+def fetch(url: str, fullpath: str, progress=None, size: int = None, check=None, resume: bool = True,
+          digests=()) -> str:
+    """Download url to fullpath through a fullpath.part file that is renamed into place when complete.
+
+    If a .part file is left over from an interrupted run (crash, Ctrl-C, dropped connection),
+    the transfer continues from its last byte with an HTTP Range request. The ETag or
+    Last-Modified date of the response that started the .part is kept in fullpath.part.validator
+    and sent as If-Range, so a file that changed upstream is downloaded again instead of being
+    joined to the old bytes. Servers that ignore the Range header get the file restarted from zero. A .part file preallocated by
+    fetch_segmented() is continued segment by segment over one connection instead.
+
+    Every algorithm in digests is computed from the blocks as they are written, so no second
+    read of the file is needed to verify it. Only a resumed .part file is read back, once.
+
+    :Parameters:
+        - url: str remote file
+        - fullpath: str final local path; nothing is written here until the file is complete
+        - progress: urlretrieve-style reporthook called as progress(1, bytes_done, total_bytes)
+        - size: int or None expected byte size. If set, a .part file of a different size is never published
+        - check: callable(partpath, hexdigests) or None that raises if the completed .part file is
+          invalid; hexdigests is a dict of algorithm name to the computed hex digest
+        - resume: bool, if False any existing .part file is discarded first
+        - digests: iterable of hashlib algorithm names to compute while downloading
+
+    :Returns:
+        fullpath
+    """
+    part = fullpath + ".part"
+    statefile = part + ".segments"
+    if os.path.exists(statefile):
+        # A .part file preallocated by fetch_segmented() has holes, it is not a prefix of the file
+        if resume and size is not None and os.path.exists(part) and _load_segments(statefile, size) is not None:
+            try:
+                return fetch_segmented(url, fullpath, size, 1, progress=progress, check=check, digests=digests)
+            except RangeNotSupported as rE:
+                LOG.warning(f"\t:: {rE}, restarting download")
+        _remove_part(part)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(statefile)
+    validatorfile = part + ".validator"
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    if not resume or (size is not None and offset > size):
+        offset = 0
+    validator = _load_validator(validatorfile) if offset else None
+    if offset and validator is None and size is None:
+        # Without a size or validator nothing tells whether the .part is still a prefix of the file
+        LOG.debug(f"\t:: No validator for {part}, restarting download")
+        offset = 0
+    hashers = {name: hashlib.new(name) for name in digests}
+
+    response = None
+    if size is None or offset < size:
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        if offset and validator:
+            # The server sends the whole file instead of the range if it changed since the .part was started
+            headers["If-Range"] = validator
+        try:
+            response = urlopen(Request(url, headers=headers), timeout=TIMEOUT)
+        except HTTPError as hE:
+            if hE.code != 416 or not offset:
+                raise
+            # The remote file is not longer than the .part: it is either complete or a different file
+            LOG.warning(f"\t:: {url} has no byte {offset}, restarting download")
+            offset = 0
+            response = urlopen(Request(url), timeout=TIMEOUT)
+
+    if response is not None:
+        with response:
+            if offset and response.status != 206:
+                LOG.warning(f"\t:: Server did not honour range request for {url} or the file changed, restarting download")
+                offset = 0
+            elif offset:
+                LOG.debug(f"\t:: Resuming {url} from byte {offset}")
+            if not offset:
+                _save_validator(validatorfile, response)
+            if offset and hashers:
+                update_hashers(hashers, part)
+            length = response.headers.get("Content-Length")
+            total = offset + int(length) if length is not None else (size or -1)
+            done = offset
+            with open(part, 'ab' if offset else 'wb') as f:
+                while True:
+                    # read1 returns what has arrived, so a stalled connection loses none of it
+                    block = response.read1(CHUNK_SIZE)
+                    if not block:
+                        break
+                    f.write(block)
+                    for h in hashers.values():
+                        h.update(block)
+                    done += len(block)
+                    if progress:
+                        progress(1, done, total)
+            if length is not None and done != total:
+                # The .part is kept, the next run resumes from it
+                raise DownloadError(f"{url}: connection closed at byte {done} of {total}")
+    elif hashers:
+        update_hashers(hashers, part)
+
+    partsize = os.path.getsize(part)
+    if size is not None and partsize != size:
+        if partsize > size:
+            _remove_part(part)
+        raise DownloadError(f"{url}: downloaded {partsize} bytes, expected {size}")
+
+    if check is not None:
+        try:
+            check(part, {name: h.hexdigest() for name, h in hashers.items()})
+        except BaseException:
+            # A hash mismatch means the bytes on disk are bad, resuming from them would never succeed
+            _remove_part(part)
+            raise
+
+    os.replace(part, fullpath)
+    _remove_part(part)
+    return fullpath
+
+def _load_validator(validatorfile: str) -> str:
+    try:
+        with open(validatorfile, 'r') as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+def _save_validator(validatorfile: str, response) -> None:
+    """Keep the strong ETag, or else the Last-Modified date, of the response the .part file holds"""
+    etag = response.headers.get("ETag")
+    validator = etag if etag and not etag.startswith("W/") else response.headers.get("Last-Modified")
+    if validator:
+        with open(validatorfile, 'w') as f:
+            f.write(validator)
+    else:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(validatorfile)
+
+def _remove_part(part: str) -> None:
+    """Remove a .part file and its validator"""
+    for path in (part, part + ".validator"):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+
+def _load_segments(statefile: str, size: int) -> set:
+    try:
+        with open(statefile, 'r') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get("size") != size or state.get("segment") != SEGMENT_SIZE:
+        return None
+    return set(state.get("done", []))
+
+def _save_segments(statefile: str, size: int, done: set) -> None:
+    with open(statefile + ".tmp", 'w') as f:
+        json.dump({"size": size, "segment": SEGMENT_SIZE, "done": sorted(done)}, f)
+    os.replace(statefile + ".tmp", statefile)
+
+def fetch_segmented(url: str, fullpath: str, size: int, connections: int, progress=None, check=None,
+                    resume: bool = True, digests=()) -> str:
+    """Download url over several connections, each fetching SEGMENT_SIZE byte ranges into a
+    preallocated sparse fullpath.part file.
+
+    Completed segments are recorded in fullpath.part.segments so a rerun only fetches the missing
+    ones. A plain .part file left by fetch() is adopted: its whole segments count as complete.
+    Segments arrive out of order, so digests are computed with one read of the finished file.
+    The size check, check callable and atomic rename behave exactly as in fetch().
+
+    :Raises:
+        DownloadError if the server does not support range requests or a segment fails;
+        segments that did complete are kept for the next run.
+    """
+    part = fullpath + ".part"
+    statefile = part + ".segments"
+    count = (size + SEGMENT_SIZE - 1) // SEGMENT_SIZE
+    done = _load_segments(statefile, size) if resume and os.path.exists(part) else None
+    if done is None:
+        partsize = os.path.getsize(part) if resume and os.path.exists(part) and not os.path.exists(statefile) else 0
+        done = set(range(min(partsize, size) // SEGMENT_SIZE))
+        with open(part, 'r+b' if done else 'wb') as f:
+            f.truncate(size)  # sparse on filesystems that support it
+        _save_segments(statefile, size, done)
+
+    lock = threading.Lock()
+    received = {"bytes": len(done) * SEGMENT_SIZE}
+
+    def get_segment(index):
+        start = index * SEGMENT_SIZE
+        end = min(start + SEGMENT_SIZE, size) - 1
+        response = urlopen(Request(url, headers={"Range": f"bytes={start}-{end}"}), timeout=TIMEOUT)
+        with response, open(part, 'r+b') as f:
+            if response.status != 206:
+                raise RangeNotSupported(f"{url}: server does not support range requests")
+            f.seek(start)
+            position = start
+            while position <= end:
+                block = response.read(min(CHUNK_SIZE, end + 1 - position))
+                if not block:
+                    raise DownloadError(f"{url}: connection closed in segment {index} at byte {position}")
+                f.write(block)
+                position += len(block)
+                with lock:
+                    received["bytes"] += len(block)
+                    if progress:
+                        progress(1, min(received["bytes"], size), size)
+        with lock:
+            done.add(index)
+            _save_segments(statefile, size, done)
+
+    missing = [i for i in range(count) if i not in done]
+    LOG.debug(f"\t:: Fetching {len(missing)}/{count} segments of {url} over {connections} connections")
+    errors = []
+    try:
+        # The first segment doubles as a probe so a server without range support is found out once
+        if missing:
+            get_segment(missing.pop(0))
+    except Exception as E:
+        errors.append(E)
+    else:
+        with ThreadPoolExecutor(max_workers=connections) as pool:
+            for future in [pool.submit(get_segment, i) for i in missing]:
+                if future.exception() is not None:
+                    errors.append(future.exception())
+    unsupported = [e for e in errors if isinstance(e, RangeNotSupported)]
+    if unsupported:
+        # The sparse .part file is useless to a single connection download
+        os.remove(part)
+        os.remove(statefile)
+        raise unsupported[0]
+    if errors:
+        raise DownloadError(f"{len(errors)} segment(s) of {url} failed: {errors[0]}")
+
+    if check is not None:
+        try:
+            check(part, hash_file(part, digests))
+        except BaseException:
+            os.remove(part)
+            os.remove(statefile)
+            raise
+
+    os.replace(part, fullpath)
+    os.remove(statefile)
+    return fullpath
+
+def connections_for(args, url: str) -> int:
+    """Number of connections to use for url from --connections.
+
+    Values are either a bare number (default for all mirrors) or host=number for a specific mirror,
+    ie: `--connections 2 --connections distfiles.gentoo.org=4`.
+    """
+    host = urlparse(url).hostname
+    connections = 1
+    for value in getattr(args, "connections", None) or []:
+        name, _, number = str(value).rpartition("=")
+        if not name:
+            connections = int(number)
+        elif name == host:
+            return max(1, int(number))
+    return max(1, connections)
+
+def fetch_artifact(args, url: str, fullpath: str, size: int, expected: dict, filename: str, progress=None) -> str:
+    """Download a large, hashed artifact (iso or stage3) and record it as verified.
+
+    Uses fetch_segmented() when more than one connection is configured for the mirror and the file
+    is large enough to split, falling back to a single connection if the server refuses ranges.
+    If a mirror fails or stalls (no data for TIMEOUT seconds) the next mirror continues from the
+    bytes already in the .part file. A hash mismatch discards the .part file and downloads the
+    file again from the next mirror; it is only raised if the last mirror serves bad bytes too.
+
+    Runs under artifact_lock(fullpath); a process that waited on another's download of the same
+    file only verifies the published result.
+    """
+    with artifact_lock(fullpath) as waited:
+        if waited and os.path.exists(fullpath):
+            # Another process published it while we waited; the verification index makes this cheap
+            assert os.path.getsize(fullpath) == size, f"{filename} size does not match expected value {size}."
+            if not is_verified(args, fullpath, expected):
+                if check_digests(args, expected, hash_file(fullpath, expected), filename):
+                    record_verified(args, fullpath, expected)
+            return fullpath
+        return _fetch_artifact(args, url, fullpath, size, expected, filename, progress=progress)
+
+def _fetch_artifact(args, url: str, fullpath: str, size: int, expected: dict, filename: str, progress=None) -> str:
+    verified = []
+    kwargs = dict(progress=progress or DownloadProgressBar(), resume=not getattr(args, "redownload", False), digests=expected,
+                  check=lambda part, computed: verified.append(check_digests(args, expected, computed, filename)))
+    urls = gentooimgr.mirrors.candidates(args, url)
+    for i, candidate in enumerate(urls):
+        connections = connections_for(args, candidate)
+        try:
+            try:
+                if connections > 1 and size >= SEGMENT_MIN_FILESIZE:
+                    fetch_segmented(candidate, fullpath, size, connections, **kwargs)
+                else:
+                    fetch(candidate, fullpath, size=size, **kwargs)
+            except RangeNotSupported as rE:
+                LOG.warning(f"\t:: {rE}, using a single connection")
+                fetch(candidate, fullpath, size=size, **kwargs)
+            break
+        except (DownloadError, OSError, AssertionError) as E:
+            if i == len(urls) - 1:
+                raise
+            LOG.warning(f"\t:: {candidate} failed ({E}), continuing from {urls[i + 1]}")
+            kwargs["resume"] = True
+            verified.clear()
+
+    if all(verified):
+        record_verified(args, fullpath, expected)
+    return fullpath
+
+def update_hashers(hashers: dict, path: str) -> dict:
+    """Feed the contents of path into every hash object in hashers with a single read"""
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(CHUNK_SIZE)
+            if not block:
+                break
+            for h in hashers.values():
+                h.update(block)
+    return hashers
+
+def hash_file(path: str, digests) -> dict:
+    """Returns a dict of algorithm name to hex digest of path, computing all of them in one read"""
+    hashers = update_hashers({name: hashlib.new(name) for name in digests}, path)
+    return {name: h.hexdigest() for name, h in hashers.items()}
+
+def fetch_metadata(args, url: str, fullpath: str, progress=None) -> str:
+    """Download or revalidate a small metadata file (latest-*.txt, hash files) with a conditional GET.
+
+    The ETag and Last-Modified of each url are kept in the download directory. While the server
+    answers 304 Not Modified, only the time of the last check is updated and the local copy is used.
+    Each mirror is tried in turn. If none can be reached, the local copy is used as long as it was
+    last confirmed within --days days; past that it is considered too stale and the error is raised.
+
+    :Returns:
+        fullpath
+    """
+    entry = {}
+    if os.path.exists(fullpath) and not getattr(args, "redownload", False):
+        entry = _load_index(args.download_dir, VALIDATOR_CACHE).get(url, {})
+    headers = {}
+    if entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+
+    response = None
+    for candidate in gentooimgr.mirrors.candidates(args, url):
+        try:
+            response = urlopen(Request(candidate, headers=headers), timeout=TIMEOUT)
+            break
+        except HTTPError as hE:
+            if hE.code != 304 or not entry:
+                error = hE
+                continue
+            LOG.debug(f"\t:: {os.path.basename(fullpath)} not modified")
+            entry["checked"] = time.time()
+            _update_index(args.download_dir, VALIDATOR_CACHE, url, entry)
+            return fullpath
+        except (URLError, OSError) as E:
+            error = E
+
+    if response is None:
+        checked = entry.get("checked") or (os.path.getmtime(fullpath) if os.path.exists(fullpath) else 0)
+        maxage = getattr(args, "days", gentooimgr.config.DAYS) * gentooimgr.config.DAY_IN_SECONDS
+        if os.path.exists(fullpath) and time.time() - checked <= maxage:
+            LOG.warning(f"\t:: Unable to revalidate {url} ({error}), using cached {os.path.basename(fullpath)}")
+            return fullpath
+        raise error
+
+    announce(f"Downloading {os.path.basename(fullpath)}", progress)
+    with response:
+        content = response.read()
+        entry = {"etag": response.headers.get("ETag"),
+                 "last_modified": response.headers.get("Last-Modified"),
+                 "checked": time.time()}
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fullpath) or ".", prefix=os.path.basename(fullpath), suffix=".part")
+    with os.fdopen(fd, 'wb') as f:
+        f.write(content)
+    os.replace(tmp, fullpath)
+    _update_index(args.download_dir, VALIDATOR_CACHE, url, entry)
+    return fullpath
+
 def parse_latest_iso_text(fullpath) -> tuple:
     """Returns a tuple of (hash type, iso name, iso bytes)"""
     with open(fullpath) as f:
@@ -68,54 +589,193 @@ def parse_latest_stage3_text(fullpath) -> tuple:
                 m_stage3.group(1) if not m_stage3 is None else None,
                 m_stage3.group(2) if not m_stage3 is None else None,)
 
-def verify(args, _type: str, baseurl: str, hashpattern, filename: str) -> bool:
+def parse_digests(content: str, filename: str, _type: str, hashpattern) -> dict:
+    """Returns a dict of hashlib algorithm name to expected hex digest for filename.
+
+    Gentoo hash and DIGESTS files group entries under "# SHA512 HASH" style headers, so every
+    algorithm listed for filename is returned. Files without headers fall back to hashpattern
+    with _type as the algorithm.
+    """
+    digests = {}
+    algorithm = None
+    for line in content.splitlines():
+        m = re.match(r"^#\s*(\w+)\s+HASH\s*$", line)
+        if m:
+            algorithm = m.group(1).lower()
+            continue
+        fields = line.split()
+        if algorithm and len(fields) == 2 and os.path.basename(fields[1]) == filename:
+            digests[algorithm] = fields[0].lower()
+
+    if not digests and _type:
+        m_hash = hashpattern.search(content)
+        if m_hash is not None:
+            digests[_type.lower()] = m_hash.group(1).lower()
+
+    return {name: digest for name, digest in digests.items() if name in hashlib.algorithms_available}
+
+def fetch_digests(args, _type: str, baseurl: str, hashpattern, filename: str, progress=None) -> dict:
+    """Downloads the hash file for filename (if needed) and returns its parsed digests.
+
+    A install-amd64-minimal-20231112T170154Z.iso file will have a
+    install-amd64-minimal-20231112T170154Z.iso.sha256 for example.
+    """
+    hashname = filename+f".{_type.lower()}"  # Update to hash file
+    hashfile = os.path.join(baseurl, hashname)
+    fullpath = os.path.join(args.download_dir, hashname)
+    fetch_metadata(args, hashfile, fullpath, progress=progress)
+
+    with open(fullpath, 'r') as f:
+        digests = parse_digests(f.read(), filename, _type, hashpattern)
+    assert digests, f"No usable digest for {filename} found in {hashname}"
+    return digests
+
+def portage_digests(args, url: str, progress=None) -> dict:
+    """Downloads the .md5sum file gentoo publishes next to each portage snapshot and returns its digest"""
+    hashname = os.path.basename(url) + ".md5sum"
+    fullpath = os.path.join(args.download_dir, hashname)
+    fetch_metadata(args, url + ".md5sum", fullpath, progress=progress)
+
+    with open(fullpath, 'r') as f:
+        m = re.search(r"^([0-9a-fA-F]{32})\s", f.read(), re.MULTILINE)
+    assert m, f"No md5 digest found in {hashname}"
+    return {"md5": m.group(1).lower()}
+
+def check_digests(args, expected: dict, computed: dict, filename: str) -> bool:
+    """Compare every expected digest to the computed one. Mismatches are fatal unless --force is set."""
+    verified = True
+    for name, _hash in expected.items():
+        hd = computed.get(name)
+        if _hash != hd and args.force:
+            LOG.error(f"Hash mismatch {hd} != {_hash} for {filename} ({name})")
+            verified = False
+        else:
+            assert hd == _hash, f"Hash mismatch {hd} != {_hash} ({name}), use --force to bypass"
+    LOG.debug(f"\t:: Verified {filename} with {', '.join(expected)}")
+    return verified
+
+def _file_key(path: str) -> dict:
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime": st.st_mtime_ns, "inode": st.st_ino}
+
+def _load_index(download_dir, name=VERIFIED_INDEX) -> dict:
+    try:
+        with open(os.path.join(download_dir, name), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _update_index(download_dir, name: str, key: str, value: dict) -> None:
+    """Set key in the json index file name, replacing the file atomically"""
+    with _index_lock, artifact_lock(os.path.join(download_dir, name), verbose=False):
+        index = _load_index(download_dir, name)
+        index[key] = value
+        fd, tmp = tempfile.mkstemp(dir=download_dir, prefix=name, suffix=".tmp")
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f, indent=4, sort_keys=True)
+        os.replace(tmp, os.path.join(download_dir, name))
+
+def prune_index(download_dir) -> None:
+    """Drop verification index entries of files that no longer exist"""
+    if not os.path.exists(os.path.join(download_dir, VERIFIED_INDEX)):
+        return
+    with _index_lock, artifact_lock(os.path.join(download_dir, VERIFIED_INDEX), verbose=False):
+        index = _load_index(download_dir)
+        kept = {path: entry for path, entry in index.items() if os.path.exists(path)}
+        if kept == index:
+            return
+        fd, tmp = tempfile.mkstemp(dir=download_dir, prefix=VERIFIED_INDEX, suffix=".tmp")
+        with os.fdopen(fd, 'w') as f:
+            json.dump(kept, f, indent=4, sort_keys=True)
+        os.replace(tmp, os.path.join(download_dir, VERIFIED_INDEX))
+
+def record_verified(args, path: str, digests: dict) -> None:
+    """Store the verified digests of path with its size, mtime and inode in the verification index"""
+    try:
+        _update_index(args.download_dir, VERIFIED_INDEX, os.path.abspath(path), dict(_file_key(path), digests=digests))
+    except OSError as E:
+        # ie: download dir on the read-only gentooimgr iso, only costs a rehash next time
+        LOG.debug(f"\t:: Unable to record verification of {path}: {E}")
+
+def verified_digests(args, path: str) -> dict:
+    """Returns the digests recorded for path if it has not changed since it was verified, otherwise None"""
+    entry = _load_index(args.download_dir).get(os.path.abspath(path))
+    if not entry or not os.path.exists(path):
+        return None
+    digests = entry.pop("digests", None)
+    return digests if entry == _file_key(path) else None
+
+def file_digest(args, path: str, algorithm: str = "sha512") -> str:
+    """Returns the hex digest of path, from the verification index if it was hashed before"""
+    digests = verified_digests(args, path) or {}
+    if algorithm not in digests:
+        digests = hash_file(path, [algorithm])
+        record_verified(args, path, digests)
+    return digests[algorithm]
+
+def is_verified(args, path: str, expected: dict) -> bool:
+    """True if path was verified before with the expected digests and has not changed since.
+
+    --redownload and --verify-deep always force a full rehash.
+    """
+    if getattr(args, "redownload", False) or getattr(args, "verify_deep", False):
+        return False
+    return verified_digests(args, path) == expected
+
+def verify(args, _type: str, baseurl: str, hashpattern, filename: str, progress=None, path=None) -> bool:
     """Downloads hash file and run a hash check on the file
     :Parameters:
         - args: Namespace of parsed arguments
         - _type: str hash type
         - baseurl: (remote) folder where hashsum file is contained
-        - hashpattern:
+        - hashpattern: fallback regex for hash files without "# ... HASH" headers
         - filename: str name of file to check (used to download corresponding hash file)
 
             A install-amd64-minimal-2023111iso2T170154Z.iso file will have a
               install-amd64-minimal-20231112T170154Z.iso.sha256 for example.
+        - progress: urlretrieve reporthook or None for a DownloadProgressBar
+        - path: str or None. File to hash if not download_dir/filename
+
+    This reads an already downloaded file; new downloads are hashed as they are fetched instead.
+    Files recorded in the verification index with the same digests, size, mtime and inode are
+    not read at all.
 
     :Returns:
         Whether iso was verified using the specified hash
 
     """
-    digest = hashlib.file_digest(open(os.path.join(args.download_dir, filename), 'rb'), _type.lower())
-    filename = filename+f".{_type.lower()}"  # Update to hash file
-    hashfile = os.path.join(baseurl, filename)
-    fullpath = os.path.join(args.download_dir, os.path.basename(hashfile))
-    if not os.path.exists(fullpath) or args.redownload or older_than_a_day(fullpath):
-        print(f"Downloading {filename}")
-        urlretrieve(hashfile, fullpath, DownloadProgressBar())
-
-    hd = digest.hexdigest()
-    with open(fullpath, 'r') as f:
-        content = f.read()
-        m_hash = hashpattern.search(content)
-        _hash = m_hash.group(1)
-        if _hash != hd and args.force:
-            LOG.error(f"Hash mismatch {hd} != {_hash} for {filename}")
-        else:
-            assert hd == _hash, f"Hash mismatch {hd} != {_hash}, use --force to bypass"
-
-def download_stage3(args, url=None, cfg={}) -> str:
+    path = path or os.path.join(args.download_dir, filename)
+    expected = fetch_digests(args, _type, baseurl, hashpattern, filename, progress=progress)
+    if is_verified(args, path, expected):
+        LOG.debug(f"\t:: {filename} unchanged since last verification, not rehashing")
+        return True
+
+    verified = check_digests(args, expected, hash_file(path, expected), filename)
+    if verified:
+        record_verified(args, path, expected)
+    return verified
+
+def stage3_config(cfg={}):
+    """Returns gentooimgr.config.config() for the stage3 architecture of cfg (or this machine)"""
     uname = cfg.get("architecture", os.uname().machine)
     LOG.debug(f"download_stage3() with uname {uname}")
     if uname.startswith("ppc"):
         uname = "ppc"  # fix gentoo not having separate 32/64bit ppc urls/files
     elif uname == "x86_64":
         uname = "amd64"
-    C = gentooimgr.config.config(architecture=uname)
+    return gentooimgr.config.config(architecture=uname)
+
+def stage3_profile(args, cfg={}) -> str:
+    """Init system of the stage3: --openrc/--systemd, else the config's initsys, defaulting to openrc"""
+    return getattr(args, "profile", None) or cfg.get("initsys") or "openrc"
+
+def latest_stage3(args, url=None, cfg={}, progress=None, profile=None) -> tuple:
+    """Revalidate the latest stage3 .txt file and return (baseurl, filename, size, hashtype) of the stage3 it names"""
+    C = stage3_config(cfg)
     LOG.debug(f"Config from architecture is {C}")
+    profile = profile or stage3_profile(args, cfg)
     if url is None:
-        if not hasattr(args, "profile"):
-            # Set this to either the config value or empty, defaulting it to openrc
-            args.profile = cfg.get("initsys")
-        if args.profile == "systemd":
+        if profile == "systemd":
             url = os.path.join(C.GENTOO_BASE_STAGE_SYSTEMD_URL, C.GENTOO_LATEST_STAGE_SYSTEMD_FILE)
 
         else:
@@ -123,39 +783,30 @@ def download_stage3(args, url=None, cfg={}) -> str:
 
     filename = os.path.basename(url)
     fullpath = os.path.join(args.download_dir, filename)
-    if not os.path.exists(fullpath) or args.redownload or older_than_a_day(fullpath):
-        urlretrieve(url, fullpath, DownloadProgressBar())
+    fetch_metadata(args, url, fullpath, progress=progress)
 
     hashtype, latest, size = parse_latest_stage3_text(fullpath)
-    size = int(size)
+    baseurl = C.GENTOO_BASE_STAGE_SYSTEMD_URL if profile == "systemd" else C.GENTOO_BASE_STAGE_OPENRC_URL
+    return baseurl, latest, int(size), hashtype
 
-    filename = latest
+def download_stage3(args, url=None, cfg={}, progress=None, profile=None) -> str:
+    baseurl, filename, size, hashtype = latest_stage3(args, url=url, cfg=cfg, progress=progress, profile=profile)
     fullpath = os.path.join(args.download_dir, filename)
-    if not os.path.exists(fullpath) or args.redownload:
-        url = os.path.join(
-                C.GENTOO_BASE_STAGE_SYSTEMD_URL if args.profile == "systemd" else \
-                C.GENTOO_BASE_STAGE_OPENRC_URL,
-                filename)
-        urlretrieve(url, fullpath, DownloadProgressBar())
+    if not os.path.exists(fullpath) or getattr(args, "redownload", False):
+        # The hash file comes first so the digest is computed while the tarball streams in
+        expected = fetch_digests(args, hashtype, baseurl, stage3hashpattern, filename, progress=progress)
+        return fetch_artifact(args, os.path.join(baseurl, filename), fullpath, size, expected, filename,
+                              progress=progress)
 
     # Verify byte size
     stage3size = os.path.getsize(fullpath)
     assert size == stage3size, f"Stage 3 size {size} does not match expected value {stage3size}."
-    verify(args, hashtype, C.GENTOO_BASE_STAGE_SYSTEMD_URL if args.profile == "systemd" else \
-           C.GENTOO_BASE_STAGE_OPENRC_URL,  stage3hashpattern, filename)
+    verify(args, hashtype, baseurl, stage3hashpattern, filename, progress=progress)
     return fullpath
 
 
-def download_portage(args, url=None, cfg={}) -> str:
-    """Handle downloading of portage system for installation into cloud image
-
-    We always download the latest portage package and rename it to today's date.
-    If using today's date to grab portage, sometimes depending on timezone, the
-    package won't be available. If always using latest, worst case scenario is you
-    have a portage package a day late.
-
-
-    """
+def latest_portage(args, url=None, cfg={}) -> tuple:
+    """Returns (url, filename) of the latest portage snapshot, named after today's date"""
     uname = cfg.get("architecture", os.uname().machine)
     if uname.startswith("ppc"):
         uname = "ppc"  # fix gentoo not having separate 32/64bit ppc urls/files
@@ -164,24 +815,49 @@ def download_portage(args, url=None, cfg={}) -> str:
         url = C.GENTOO_PORTAGE_FILE
 
     base = os.path.basename(url)  # Uses 'latest' filename
-    today = date.today()
-    # Write latest to today's date so we don't constantly redownload, but
-    filename = base.replace("latest", "%d%d%d" % (today.year, today.month, today.day))
+    # Write latest to today's date (YYYYMMDD, same as gentoo's dated snapshots) so we don't constantly redownload
+    return url, base.replace("latest", date.today().strftime("%Y%m%d"))
+
+def download_portage(args, url=None, cfg={}, progress=None) -> str:
+    """Handle downloading of portage system for installation into cloud image
+
+    We always download the latest portage package and rename it to today's date.
+    If using today's date to grab portage, sometimes depending on timezone, the
+    package won't be available. If always using latest, worst case scenario is you
+    have a portage package a day late.
+
+    progress is an optional urlretrieve reporthook, defaulting to a DownloadProgressBar.
+    """
+    url, filename = latest_portage(args, url=url, cfg=cfg)
     fullpath = os.path.join(args.download_dir, filename)
+    # Only build and lock have --redownload
+    redownload = getattr(args, "redownload", False)
     # Portage is always "latest" in this case, so definitely check if older than a day and redownload.
-    if not os.path.exists(fullpath) or args.redownload or older_than_a_day(fullpath):
-        print(f"Downloading {filename} ({base})")
-        urlretrieve(url, fullpath, DownloadProgressBar())
+    if not os.path.exists(fullpath) or redownload or older_than_a_day(fullpath):
+        with artifact_lock(fullpath) as waited:
+            if waited and os.path.exists(fullpath):
+                return fullpath
+            announce(f"Downloading {filename} ({os.path.basename(url)})", progress)
+            urls = gentooimgr.mirrors.candidates(args, url)
+            for i, candidate in enumerate(urls):
+                try:
+                    fetch(candidate, fullpath, progress or DownloadProgressBar(), resume=not redownload or i > 0)
+                    break
+                except (DownloadError, OSError) as E:
+                    if i == len(urls) - 1:
+                        raise
+                    LOG.warning(f"\t:: {candidate} failed ({E}), continuing from {urls[i + 1]}")
 
     return fullpath
 
 
-def download(args, config, url=None) -> str:
+def download(args, config, url=None, progress=None) -> str:
     """Download txt file with iso name and hash type
     :Parameters:
         - args: Namespace with parsed arguments
         - config: Namespace of configurations from gentooimgr.config.config()
         - url: str or None. If None, will generate a url to the latest minimal install iso
+        - progress: urlretrieve reporthook or None. If None, a DownloadProgressBar is used
 
     :Returns:
         Full path to the downloaded iso file
@@ -196,9 +872,7 @@ def download(args, config, url=None) -> str:
     # Download the latest txt file
     filename = os.path.basename(url)
     fullpath = os.path.join(args.download_dir, filename)
-    if not os.path.exists(fullpath) or args.redownload or older_than_a_day(fullpath):
-        print(f"Downloading {filename}")
-        urlretrieve(url, fullpath, DownloadProgressBar())
+    fetch_metadata(args, url, fullpath, progress=progress)
 
     hashtype, latest, size = parse_latest_iso_text(fullpath)
     size = int(size)
@@ -206,14 +880,17 @@ def download(args, config, url=None) -> str:
     # Download the iso file
     filename = latest
     fullpath = os.path.join(args.download_dir, filename)
-    if not os.path.exists(fullpath) or args.redownload :
-        print(f"Downloading {filename}")
+    if not os.path.exists(fullpath) or getattr(args, "redownload", False) :
+        announce(f"Downloading {filename}", progress)
         url = os.path.join(config.GENTOO_BASE_ISO_URL, filename)
-        urlretrieve(url, fullpath, DownloadProgressBar())
+        # The hash file comes first so the digest is computed while the iso streams in
+        expected = fetch_digests(args, hashtype, config.GENTOO_BASE_ISO_URL, isohashpattern, filename,
+                                 progress=progress)
+        return fetch_artifact(args, url, fullpath, size, expected, filename, progress=progress)
 
     # Verify byte size
     isosize = os.path.getsize(fullpath)
     assert size == isosize, f"ISO size {size} does not match expected value {isosize}."
-    verify(args, hashtype, config.GENTOO_BASE_ISO_URL, isohashpattern, filename)
+    verify(args, hashtype, config.GENTOO_BASE_ISO_URL, isohashpattern, filename, progress=progress)
 
     return fullpath
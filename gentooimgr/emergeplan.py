@@ -0,0 +1,161 @@
+"""Consolidated emerge plan for step 10
+
+The package groups are merged with one `emerge --update` call per set of options, in calls() order.
+All groups are resolved once with `emerge --pretend` (cached in the guest) and calls whose atoms are
+already up to date are skipped. With --pretend the plan is resolved in the guest and only logged.
+"""
+
+import os
+import re
+import json
+import hashlib
+import gentooimgr.binpkg
+import gentooimgr.common
+import gentooimgr.config
+import gentooimgr.jobs
+import gentooimgr.timing
+from gentooimgr.process import run, run_cmd
+from gentooimgr.logging import LOG
+
+PLAN_CACHE = "/var/cache/gentooimgr/emerge-plans"
+# Directories of the portage tree the snapshot timestamp is read from
+REPO_PATHS = ("/var/db/repos/gentoo", "/usr/portage")
+ATOM_RE = re.compile(r"^(?P<operator>[<>=~!]*)(?:(?P<cat>[\w+.-]+)/)?(?P<name>[\w+.*-]+)")
+PLAN_RE = re.compile(r"^\[(?:ebuild|binary)[^\]]*\]\s+(?P<cat>[\w+.-]+)/(?P<pf>[^\s:]+)", re.MULTILINE)
+
+
+def calls(args, cfg: dict) -> list:
+    """Returns the emerge calls as a list of {"name", "options", "atoms"} in the order they run.
+
+    The order is the one step 10 always had: the kernel is merged before keepgoing, which goes before
+    the bootloader and base packages.
+    """
+    packages = cfg.get("packages", {})
+    jobs = gentooimgr.jobs.emerge_options(args)
+    default = packages.get("bootloader", ['sys-boot/grub:2']) + packages.get("base", [])
+    default += packages.get("additional", []) + list(getattr(args, "packages", None) or [])
+    planned = [
+        {"name": "oneshots", "options": ["--oneshot"], "atoms": packages.get("oneshots", [])},
+        {"name": "singles", "options": ["--jobs", "1"], "atoms": packages.get("singles", [])},
+        {"name": "kernel", "options": jobs, "atoms": packages.get("kernel", [])},
+        {"name": "keepgoing", "options": jobs + ["--keep-going"], "atoms": packages.get("keepgoing", [])},
+        {"name": "packages", "options": jobs, "atoms": default},
+    ]
+    return [call for call in planned if call["atoms"]]
+
+
+def split_atom(atom: str) -> tuple:
+    """Returns (category or None, package name) of a dependency atom"""
+    m = ATOM_RE.match(atom)
+    if not m:
+        return (None, atom)
+    name = m.group("name")
+    # Only atoms with an operator carry a version
+    if m.group("operator"):
+        name = gentooimgr.common.split_cpv(name.rstrip("*"))[0]
+    return (m.group("cat"), name)
+
+
+def parse_plan(output: str) -> list:
+    """Returns the category/package-version entries of `emerge --pretend` output"""
+    return [f"{m.group('cat')}/{m.group('pf')}" for m in PLAN_RE.finditer(output)]
+
+
+def pending(atom: str, merges: list) -> bool:
+    """True if the plan merges the package atom refers to. Sets and atoms ATOM_RE cannot parse are
+    always kept, as the plan does not tell which packages they stand for."""
+    if atom.startswith("@") or ATOM_RE.match(atom) is None:
+        return True
+    cat, pn = split_atom(atom)
+    for entry in merges:
+        ecat, epn = gentooimgr.common.split_cpv(entry)[0].split("/", 1)
+        if epn == pn and cat in (None, ecat):
+            return True
+    return False
+
+
+def target_root(cfg: dict) -> str:
+    """/ inside the chroot, or the mountpoint when running outside of it (--pretend)"""
+    mountpoint = cfg.get("mountpoint") or gentooimgr.config.GENTOO_MOUNT
+    return mountpoint if os.path.isdir(mountpoint) and os.path.realpath(mountpoint) != os.sep else os.sep
+
+
+def plan_key(planned: list, root: str = os.sep) -> str:
+    """Hash of the calls, make.conf, profile and portage tree timestamp"""
+    timestamp = None
+    for repo in REPO_PATHS:
+        path = os.path.join(root, repo.lstrip(os.sep), "metadata", "timestamp.chk")
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                timestamp = f.read().strip()
+            break
+    profile = os.path.join(root, "etc", "portage", "make.profile")
+    key = {
+        "calls": [[call["options"], call["atoms"]] for call in planned],
+        "make.conf": gentooimgr.common.make_conf(root),
+        "profile": os.readlink(profile) if os.path.islink(profile) else None,
+        "timestamp": timestamp
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def resolve(args, planned: list, root: str = os.sep) -> list:
+    """Resolve every call at once in the guest at root, returning the packages that would be merged
+    or None on failure"""
+    atoms = [atom for call in planned for atom in call["atoms"]]
+    cmd = ["emerge", "--pretend", "--quiet", "--update", "--color=n"] + gentooimgr.binpkg.emerge_options(args) + atoms
+    if root != os.sep:
+        cmd = ["chroot", root] + cmd
+    LOG.info(f"\t:: Resolving {len(atoms)} packages")
+    try:
+        code, out, err = run(cmd)
+    except OSError as E:
+        LOG.warning(f"\t:: Unable to resolve the emerge plan: {E}")
+        return None
+    if code:
+        LOG.warning("\t:: emerge --pretend failed, running every package group without a plan")
+        return None
+    return parse_plan(out.decode(errors="replace"))
+
+
+def plan(args, cfg: dict) -> tuple:
+    """Returns the calls to run, without the atoms that are already up to date, and the packages
+    they merge (None if they could not be resolved)"""
+    planned = calls(args, cfg)
+    root = target_root(cfg)
+    cache = os.path.join(root, PLAN_CACHE.lstrip(os.sep), plan_key(planned, root) + ".json")
+    merges = None
+    if os.path.exists(cache):
+        with open(cache, 'r') as f:
+            merges = json.load(f)
+        LOG.info(f"\t:: Using cached emerge plan {cache}")
+    else:
+        merges = resolve(args, planned, root)
+        if merges is not None and not args.pretend:
+            os.makedirs(os.path.dirname(cache), exist_ok=True)
+            with open(cache, 'w') as f:
+                json.dump(merges, f, indent=4)
+    if merges is None:
+        return (planned, None)
+
+    LOG.info(f"\t:: Emerge plan: {len(merges)} packages to merge")
+    for entry in merges:
+        LOG.info(f"\t::\t{entry}")
+    filtered = []
+    for call in planned:
+        atoms = [atom for atom in call["atoms"] if pending(atom, merges)]
+        if atoms:
+            filtered.append(dict(call, atoms=atoms))
+        else:
+            LOG.info(f"\t:: Skipping {call['name']}, already up to date")
+    return (filtered, merges)
+
+
+def execute(args, cfg: dict, env=None) -> None:
+    """Run the planned emerge calls"""
+    planned, merges = plan(args, cfg)
+    with gentooimgr.timing.watch(args, cfg, merges):
+        for call in planned:
+            LOG.info(f"\t:: Emerging {call['name']}: {' '.join(call['atoms'])}")
+            cmd = ["emerge", "--update", *call["options"]] + gentooimgr.binpkg.emerge_options(args) + call["atoms"]
+            run_cmd(args, cmd, env=env)
@@ -0,0 +1,348 @@
+"""Parallel archive extraction for stage3 and portage tarballs
+
+extract() hands tar the fastest available decoder (pixz, xz -T, zstd, pigz, lbzip2), or decompresses
+the blocks of multi-block .xz files across processes itself. stream_extract() extracts straight from
+the network, hashing the same bytes, and only moves the result into place once the digests match.
+"""
+
+import os
+import stat
+import lzma
+import time
+import hashlib
+import tempfile
+import contextlib
+import shutil
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from subprocess import Popen, PIPE
+from urllib.request import urlopen, Request
+import gentooimgr.config
+import gentooimgr.download
+import gentooimgr.mirrors
+from gentooimgr.process import run, run_cmd
+from gentooimgr.logging import LOG
+
+# First xz release with multi-threaded decompression, in `xz --robot --version` format
+XZ_MT_VERSION = 50040002
+XZ_HEADER_SIZE = 12
+# Single-threaded decoders for tar --use-compress-program when no parallel one is available
+DECODERS = {".xz": "xz", ".txz": "xz", ".zst": "zstd", ".zstd": "zstd", ".gz": "gzip", ".tgz": "gzip", ".bz2": "bzip2"}
+# Ownership and xattrs of a stage3 must be kept exactly as archived
+STAGE3_OPTIONS = ["--xattrs-include=*.*", "--numeric-owner"]
+XZ_FOOTER_MAGIC = b"YZ"
+
+
+def _xz_version() -> int:
+    try:
+        code, out, err = run(["xz", "--robot", "--version"])
+    except OSError:
+        return 0
+    for line in out.decode().splitlines():
+        if line.startswith("XZ_VERSION="):
+            return int(line.split("=", 1)[1])
+    return 0
+
+
+def compress_program(archive: str, threads: int = gentooimgr.config.THREADS) -> str:
+    """Returns the parallel decoder for tar --use-compress-program, or None if there is none for archive"""
+    if archive.endswith((".xz", ".txz")):
+        if shutil.which("pixz"):
+            return "pixz"
+        if shutil.which("xz") and _xz_version() >= XZ_MT_VERSION:
+            return f"xz -T{threads}"
+    elif archive.endswith((".zst", ".zstd")) and shutil.which("zstd"):
+        return f"zstd -T{threads}"
+    elif archive.endswith((".gz", ".tgz")) and shutil.which("pigz"):
+        return f"pigz -p {threads}"
+    elif archive.endswith(".bz2") and shutil.which("lbzip2"):
+        return f"lbzip2 -n {threads}"
+    return None
+
+
+def _varint(data: bytes, pos: int) -> tuple:
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        value |= (byte & 0x7F) << shift
+        pos += 1
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def _encode_varint(value: int) -> bytes:
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def xz_blocks(archive: str) -> list:
+    """Returns (stream header, offset, unpadded size, uncompressed size) of every block in an .xz file.
+
+    Read from the stream indexes at the end of the file, so only a few KiB are read. Raises ValueError
+    if the file is not a valid xz file.
+    """
+    blocks = []
+    with open(archive, 'rb') as f:
+        end = f.seek(0, os.SEEK_END)
+        while end > 0:
+            # Stream padding between and after streams
+            f.seek(end - 4)
+            if f.read(4) == b"\0\0\0\0":
+                end -= 4
+                continue
+            f.seek(end - XZ_HEADER_SIZE)
+            footer = f.read(XZ_HEADER_SIZE)
+            if footer[10:] != XZ_FOOTER_MAGIC:
+                raise ValueError(f"{archive} has no xz stream footer")
+            index_size = (struct.unpack("<I", footer[4:8])[0] + 1) * 4
+            index_start = end - XZ_HEADER_SIZE - index_size
+            f.seek(index_start)
+            index = f.read(index_size)
+            if index[0] != 0:
+                raise ValueError(f"{archive} has an invalid xz index")
+
+            count, pos = _varint(index, 1)
+            records = []
+            for _ in range(count):
+                unpadded, pos = _varint(index, pos)
+                uncompressed, pos = _varint(index, pos)
+                records.append((unpadded, uncompressed))
+            stream_start = index_start - sum((u + 3) & ~3 for u, _ in records) - XZ_HEADER_SIZE
+            f.seek(stream_start)
+            header = f.read(XZ_HEADER_SIZE)
+
+            offset = stream_start + XZ_HEADER_SIZE
+            stream = []
+            for unpadded, uncompressed in records:
+                stream.append((header, offset, unpadded, uncompressed))
+                offset += (unpadded + 3) & ~3
+            blocks[:0] = stream
+            end = stream_start
+    return blocks
+
+
+def _decompress_block(archive: str, header: bytes, offset: int, unpadded: int, uncompressed: int) -> bytes:
+    """Decompress one xz block by wrapping it in a single-block stream of its own"""
+    with open(archive, 'rb') as f:
+        f.seek(offset)
+        block = f.read((unpadded + 3) & ~3)
+    index = b"\0" + _encode_varint(1) + _encode_varint(unpadded) + _encode_varint(uncompressed)
+    index += b"\0" * (-len(index) % 4)
+    index += struct.pack("<I", zlib.crc32(index))
+    body = struct.pack("<I", len(index) // 4 - 1) + header[6:8]
+    footer = struct.pack("<I", zlib.crc32(body)) + body + XZ_FOOTER_MAGIC
+    return lzma.decompress(header + block + index + footer, format=lzma.FORMAT_XZ)
+
+
+def _extract_blocks(cmd: list, archive: str, blocks: list, threads: int) -> int:
+    """Decompress xz blocks on a process pool and write them to tar in order"""
+    proc = Popen(cmd, stdin=PIPE)
+    pending = deque()
+    try:
+        with ProcessPoolExecutor(max_workers=threads) as pool:
+            for block in blocks:
+                pending.append(pool.submit(_decompress_block, archive, *block))
+                # Bound the decompressed data held in memory
+                if len(pending) >= threads * 2:
+                    proc.stdin.write(pending.popleft().result())
+            while pending:
+                proc.stdin.write(pending.popleft().result())
+    except BrokenPipeError:
+        LOG.error(f"\t:: tar exited before {archive} was fully extracted")
+    finally:
+        for future in pending:
+            future.cancel()
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+    return proc.wait()
+
+
+def extract(args, archive, dest: str, options=(), threads: int = gentooimgr.config.THREADS) -> int:
+    """Extract the tarball archive into dest with the fastest available decoder and log the throughput.
+
+    :Parameters:
+        - options: additional tar options, ie: ["--xattrs-include=*.*", "--numeric-owner"]
+
+    :Returns:
+        tar return code
+    """
+    archive = os.path.abspath(str(archive))
+    program = compress_program(archive, threads)
+    blocks = []
+    if archive.endswith((".xz", ".txz")):
+        try:
+            blocks = xz_blocks(archive)
+        except (OSError, ValueError) as E:
+            LOG.debug(f"\t:: Unable to read xz index of {archive}: {E}")
+
+    stream = not program and len(blocks) > 1 and threads > 1
+    if program:
+        LOG.info(f"\t:: Extracting {os.path.basename(archive)} with {program}")
+        cmd = ["tar", "xp", f"--use-compress-program={program}", *options, "-C", dest, "-f", archive]
+    elif stream:
+        LOG.info(f"\t:: Extracting {os.path.basename(archive)}, {len(blocks)} xz blocks on {threads} processes")
+        cmd = ["tar", "xp", *options, "-C", dest, "-f", "-"]
+    else:
+        LOG.info(f"\t:: Extracting {os.path.basename(archive)} (no parallel decoder available)")
+        cmd = ["tar", "xpf", archive, *options, "-C", dest]
+
+    if args.pretend:
+        LOG.info(f"PRETEND {' '.join(cmd)}")
+        return 0
+
+    start = time.monotonic()
+    if stream:
+        code = _extract_blocks(cmd, archive, blocks, threads)
+    else:
+        code, out, err = run_cmd(args, cmd)
+    elapsed = max(time.monotonic() - start, 1e-6)
+
+    if code:
+        LOG.error(f"\t:: Extracting {archive} failed with exit code {code}")
+        return code
+    size = os.path.getsize(archive)
+    rate = f"{size / elapsed / 2**20:.1f} MiB/s compressed"
+    if blocks:
+        rate += f", {sum(b[3] for b in blocks) / elapsed / 2**20:.1f} MiB/s extracted"
+    LOG.info(f"\t:: Extracted {size >> 20} MiB in {elapsed:.1f}s ({rate})")
+    return code
+
+
+def decoder(archive: str, threads: int = gentooimgr.config.THREADS) -> str:
+    """Returns the program tar should decompress archive with, preferring a parallel one"""
+    program = compress_program(archive, threads)
+    if program:
+        return program
+    suffix = os.path.splitext(archive)[1]
+    if suffix not in DECODERS:
+        raise ValueError(f"Unknown compression of {archive}")
+    return DECODERS[suffix]
+
+
+def _merge(src: str, dest: str) -> None:
+    """Move the contents of src into dest. Directories that already exist in dest are merged into
+    and take the mode (and as root the owner) of the extracted one, as tar would have set them."""
+    for name in os.listdir(src):
+        source, target = os.path.join(src, name), os.path.join(dest, name)
+        if os.path.isdir(source) and not os.path.islink(source) and os.path.isdir(target) \
+                and not os.path.islink(target):
+            st = os.lstat(source)
+            os.chmod(target, stat.S_IMODE(st.st_mode))
+            if os.geteuid() == 0:
+                os.chown(target, st.st_uid, st.st_gid)
+            _merge(source, target)
+        else:
+            os.replace(source, target)
+
+
+def stream_extract(args, url: str, dest: str, options=(), size: int = None, expected: dict = None,
+                   filename: str = None, cache: str = None, progress=None) -> None:
+    """Download url and extract it into dest in one pass, without writing the archive first.
+
+    :Parameters:
+        - size: int or None, expected byte size
+        - expected: dict of algorithm to hex digest the download must match
+        - cache: str or None, path to also save the archive to. It is only published (and recorded
+          as verified) once the digests match
+        - progress: urlretrieve-style reporthook
+
+    A mirror failing mid-stream is continued from the next one with a range request. If tar,
+    the transfer or the digest check fails, the staging directory is removed, dest is left as it
+    was and the error is raised.
+    """
+    filename = filename or os.path.basename(url)
+    if not expected:
+        raise ValueError(f"No digests to verify {filename} against, refusing to stream-extract it")
+    program = decoder(filename)
+    cmd = ["tar", "xp", f"--use-compress-program={program}", *options, "-f", "-"]
+    if args.pretend:
+        LOG.info(f"PRETEND stream {url} | {' '.join(cmd)} -C {dest}")
+        return
+
+    LOG.info(f"\t:: Streaming {filename} into {dest} with {program}")
+    lock = gentooimgr.download.artifact_lock(cache) if cache else contextlib.nullcontext()
+    with lock:
+        _stream_extract(args, url, dest, cmd, size, expected, filename, cache, progress)
+
+
+def _stream_extract(args, url, dest, cmd, size, expected, filename, cache, progress) -> None:
+    # On the same file system as dest, so moving the result into place is a rename
+    staging = tempfile.mkdtemp(prefix=".gentooimgr-stream-", dir=dest)
+    hashers = {name: hashlib.new(name) for name in expected}
+    proc = Popen(cmd + ["-C", staging], stdin=PIPE)
+    part = open(cache + ".part", 'wb') if cache else None
+    start = time.monotonic()
+    done = 0
+    try:
+        urls = gentooimgr.mirrors.candidates(args, url)
+        for i, candidate in enumerate(urls):
+            try:
+                headers = {"Range": f"bytes={done}-"} if done else {}
+                with urlopen(Request(candidate, headers=headers), timeout=gentooimgr.download.TIMEOUT) as response:
+                    if done and response.status != 206:
+                        raise gentooimgr.download.DownloadError(f"{candidate} does not support range requests")
+                    while True:
+                        block = response.read(gentooimgr.download.CHUNK_SIZE)
+                        if not block:
+                            break
+                        proc.stdin.write(block)
+                        for h in hashers.values():
+                            h.update(block)
+                        if part:
+                            part.write(block)
+                        done += len(block)
+                        if progress:
+                            progress(1, done, size or -1)
+                if size is not None and done != size:
+                    raise gentooimgr.download.DownloadError(f"{candidate}: received {done} bytes, expected {size}")
+                break
+            except BrokenPipeError:
+                # tar exited, the exit code below explains why
+                break
+            except (gentooimgr.download.DownloadError, OSError) as E:
+                if i == len(urls) - 1 or (size is not None and done > size):
+                    raise
+                LOG.warning(f"\t:: {candidate} failed ({E}), continuing from {urls[i + 1]}")
+
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        code = proc.wait()
+        if code:
+            raise RuntimeError(f"tar exited with code {code} while extracting {filename}")
+        verified = gentooimgr.download.check_digests(args, expected, {name: h.hexdigest() for name, h in hashers.items()},
+                                                     filename)
+    except BaseException:
+        if proc.poll() is None:
+            proc.kill()
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        proc.wait()
+        LOG.error(f"\t:: Streaming {filename} failed, removing what was extracted of it")
+        shutil.rmtree(staging, ignore_errors=True)
+        if part:
+            part.close()
+            os.remove(cache + ".part")
+        raise
+
+    _merge(staging, dest)
+    shutil.rmtree(staging)
+    if part:
+        part.close()
+        os.replace(cache + ".part", cache)
+        if verified:
+            gentooimgr.download.record_verified(args, cache, expected)
+    elapsed = max(time.monotonic() - start, 1e-6)
+    LOG.info(f"\t:: Streamed and extracted {done >> 20} MiB in {elapsed:.1f}s ({done / elapsed / 2**20:.1f} MiB/s)")
@@ -14,7 +14,18 @@ import gentooimgr.configs
 import gentooimgr.common
 import gentooimgr.chroot
 import gentooimgr.download
+import gentooimgr.extract
+import gentooimgr.lockfile
+import gentooimgr.binpkg
+import gentooimgr.jobs
+import gentooimgr.emergeplan
+import gentooimgr.ccache
+import gentooimgr.rootfs
+import gentooimgr.tmpdir
+import gentooimgr.timing
+import gentooimgr.squashfs
 import gentooimgr.kernel
+import gentooimgr.kernelcache
 import gentooimgr.errorcodes
 import gentooimgr.newworld
 from gentooimgr.process import run_cmd, run
@@ -23,9 +34,6 @@ from gentooimgr.logging import LOG
 
 from gentooimgr.configs import *
 
-# LEFTOFF FIXME : Have a way to specify thread count in every emerge command, maybe limit cmake?
-EMERGE_CMD = ["emerge", "-j", gentooimgr.config.THREADS]
-
 FILES_DIR = os.path.join(HERE, "..")
 
 STEPS = {
@@ -125,9 +133,51 @@ def step2_mount(args, cfg):
         run_cmd(args, c, stdout=PIPE, stderr=PIPE)
     completestep(args, 2, "mount")
 
+def emerge_cmd(args, *options) -> list:
+    """Returns an emerge command with options and the options of enabled caches"""
+    return ["emerge", *options] + gentooimgr.binpkg.emerge_options(args)
+
+def stream_source(args, cfg, name) -> dict:
+    """Returns the lockfile-style entry (name, url, size, digests) of the stage3 or portage file to
+    stream-extract, or None if --stream-extract does not apply because the file is set or already local.
+    """
+    if not getattr(args, "stream_extract", False) or cfg.get(name) or getattr(args, name, None):
+        return None
+    locked = gentooimgr.lockfile.load(args, cfg)
+    if locked:
+        entry = locked[name]
+    elif not args.install_only:
+        return None
+    elif name == "stage3":
+        baseurl, filename, size, hashtype = gentooimgr.download.latest_stage3(args, cfg=cfg)
+        digests = gentooimgr.download.fetch_digests(args, hashtype, baseurl, gentooimgr.download.stage3hashpattern, filename)
+        entry = {"name": filename, "url": os.path.join(baseurl, filename), "size": size, "digests": digests}
+    else:
+        url, filename = gentooimgr.download.latest_portage(args, cfg=cfg)
+        digests = gentooimgr.download.portage_digests(args, url)
+        entry = {"name": filename, "url": url, "size": None, "digests": digests}
+    if os.path.exists(os.path.join(args.download_dir, entry["name"])):
+        return None
+    return entry
+
+def stream_extract(args, entry: dict, dest: str, options=()) -> None:
+    cache = os.path.join(args.download_dir, entry["name"]) if args.stream_keep else None
+    gentooimgr.extract.stream_extract(args, entry["url"], dest, options, size=entry["size"], expected=entry["digests"],
+                                      filename=entry["name"], cache=cache)
+
 def step3_stage3(args, cfg):
     LOG.info(f":: Step 3: {STEPS[3]}")
-    if args.install_only:
+    entry = stream_source(args, cfg, "stage3")
+    if entry:
+        stream_extract(args, entry, cfg.get("mountpoint"), gentooimgr.extract.STAGE3_OPTIONS)
+        completestep(args, 3, "stage3")
+        return
+
+    locked = gentooimgr.lockfile.load(args, cfg)
+    if locked and not (cfg.get("stage3") or args.stage3):
+        # Pinned stage3, downloaded only if missing
+        args.stage3 = gentooimgr.lockfile.resolve(args, locked["stage3"])
+    elif args.install_only:
         # download stage3 to FILES_DIR
         gentooimgr.download.download_stage3(args, cfg=cfg)
     stage3 = cfg.get("stage3") or args.stage3  # FIXME: auto detect stage3 images in mountpoint and add here
@@ -135,9 +185,12 @@ def step3_stage3(args, cfg):
         stage3 = gentooimgr.common.stage3_from_dir(FILES_DIR)
 
     LOG.info(f":: Stage 3 file selected: {stage3}")
-    cmd = ["tar", "xpf", os.path.abspath(stage3), "--xattrs-include='*.*'", "--numeric-owner", "-C",
-                  f'{cfg.get("mountpoint")}']
-    run_cmd(args, cmd)
+    cache = getattr(args, "template_cache", None)
+    if cache:
+        template = gentooimgr.rootfs.ensure_template(args, stage3, cache)
+        gentooimgr.rootfs.populate(args, template, cfg.get("mountpoint"))
+    else:
+        gentooimgr.extract.extract(args, stage3, cfg.get("mountpoint"), gentooimgr.extract.STAGE3_OPTIONS)
     completestep(args, 3, "stage3")
 
 def step4_binds(args, cfg):
@@ -147,27 +200,33 @@ def step4_binds(args, cfg):
 
 def step5_portage(args, cfg):
     LOG.info(f':: Step 5: {STEPS[5]}')
-    if args.install_only:
-        # download stage3 to FILES_DIR
-        gentooimgr.download.download_portage(args, cfg=cfg)
-    portage = cfg.get("portage") or args.portage
-    if not portage:
-        portage = gentooimgr.common.portage_from_dir(FILES_DIR)
-
-    portage = str(portage)  # --portage = posixpath, not str
-    LOG.info(f"\t:: Portage file selected: {portage}")
-    run_cmd(args, ["tar", "xpf", portage, "-C", f"{cfg.get('mountpoint')}/usr/"])
-    # Edit portage
-    portage_env = os.path.join(cfg.get("mountpoint"), 'etc', 'portage', 'env')
-    os.makedirs(portage_env, exist_ok=True)
-    with open(os.path.join(portage_env, 'singlejob.conf'), 'w') as f:
-        f.write('MAKEOPTS="-j1"\n')
-    LOG.info("\t:: Portage single job configuration file written")
-
-    env_path = os.path.join(cfg.get("mountpoint"), 'etc', 'portage', 'package.env')
-    with open(env_path, 'w') as f:
-        f.write("app-portage/eix singlejob.conf\ndev-util/maturin singlejob.conf\ndev-util/cmake singlejob.conf")
-    LOG.info("\t:: Portage package environment configuration file written")
+    squashfs = getattr(args, "portage_squashfs", None)
+    if squashfs and not gentooimgr.squashfs.available():
+        LOG.warning("\t:: Neither tar2sqfs nor mksquashfs is installed, extracting portage instead")
+        squashfs = None
+    entry = None if squashfs else stream_source(args, cfg, "portage")
+    if entry:
+        stream_extract(args, entry, f"{cfg.get('mountpoint')}/usr/")
+    else:
+        locked = gentooimgr.lockfile.load(args, cfg)
+        if locked and not (cfg.get("portage") or args.portage):
+            args.portage = gentooimgr.lockfile.resolve(args, locked["portage"])
+        elif args.install_only:
+            # download stage3 to FILES_DIR
+            gentooimgr.download.download_portage(args, cfg=cfg)
+        portage = cfg.get("portage") or args.portage
+        if not portage:
+            portage = gentooimgr.common.portage_from_dir(FILES_DIR)
+
+        portage = str(portage)  # --portage = posixpath, not str
+        LOG.info(f"\t:: Portage file selected: {portage}")
+        if squashfs:
+            image = gentooimgr.squashfs.ensure_image(args, portage, squashfs)
+            gentooimgr.squashfs.mount(args, image, cfg.get("mountpoint"))
+        else:
+            gentooimgr.extract.extract(args, portage, f"{cfg.get('mountpoint')}/usr/")
+    # MAKEOPTS of memory-heavy packages and builds too large for the tmpfs
+    gentooimgr.jobs.write_package_env(args, cfg)
 
     completestep(args, 5, "portage")
 
@@ -251,8 +310,12 @@ def step9_sync(args, cfg):
         emergecmd .append("--quiet")
     run_cmd(args, emergecmd)
     LOG.debug("\t:: Sync'd")
+    gentooimgr.ccache.install(args)
     LOG.info("\t:: Emerging base")
-    run_cmd(args, ["emerge", "--update", "--deep", "--newuse", "--keep-going", "@world"], env=env)
+    with gentooimgr.timing.watch(args, cfg):
+        run_cmd(args, emerge_cmd(args, *gentooimgr.jobs.emerge_options(args), "--update", "--deep", "--newuse",
+                                  "--keep-going", "@world"), env=env)
+    gentooimgr.timing.record(args, cfg)
     LOG.debug("\t:: World Emerged")
     completestep(args, 9, "sync")
 
@@ -264,39 +327,15 @@ def step10_emerge_pkgs(args, cfg):
                                                  "configs",
                                                  "powerpc64.make.conf"),
                         os.path.join(cfg.get("mountpoint"), 'etc', 'make.conf')])
-    packages = cfg.get("packages", {})
     env = os.environ
     if args.ignore_collisions:
         os.environ['COLLISION_IGNORE'] = ' '.join(args.ignore_collisions)
-    for one in packages.get("oneshots", []):
-        LOG.debug(f"\t:: Oneshot packages: {one}")
-        run_cmd(args, ["emerge", "--oneshot", one])
-
-    for single in packages.get("singles", []):
-        LOG.debug(f"\t:: Single packages: {single}")
-        run_cmd(args, ["emerge", "-j", "1", single], env=env)
-
-    if packages.get("kernel", []):
-        run_cmd(args, ["emerge", "-j", str(args.threads)] + packages.get("kernel", []), env=env)
-
-    cmd = ["emerge", "-j", str(args.threads), "--keep-going"]
-    cmd += packages.get("keepgoing", [])
-    run_cmd(args, cmd, env=env)
     if args.parttype == "efi" and not args.pretend:
         LOG.info(":: Setting GRUB_PLATFORMS in make.conf")
         with open('/etc/portage/make.conf', 'a') as make_conf:
             make_conf.write("GRUB_PLATFORMS=\"efi-64\"\n")
 
-    cmd = ["emerge", "-j", str(args.threads)]
-    cmd += packages.get("bootloader", ['sys-boot/grub:2'])
-    run_cmd(args, cmd, env=env)
-    LOG.info("\t:: Installing {}".format(packages.get("bootloader")))
-    cmd = ["emerge", "-j", str(args.threads)]
-    cmd += packages.get("base", [])
-    cmd += packages.get("additional", [])
-    if hasattr(args, "packages"):
-        cmd += args.packages or []
-    run_cmd(args, cmd, env=env)
+    gentooimgr.emergeplan.execute(args, cfg, env=env)
     try:
         run_cmd(args, ["eix-update"], env=env)
         LOG.debug("\t:: eix Updated")
@@ -304,6 +343,8 @@ def step10_emerge_pkgs(args, cfg):
         # eix is assumed to be installed based on our base.json package, but custom configs may not have it.
         # That means this is non-essential to occur.
         LOG.warning("eix-update failed to run, is eix installed?")
+    gentooimgr.binpkg.report(args)
+    gentooimgr.timing.record(args, cfg)
     completestep(args, 10, "pkgs")
 
 def step11_kernel(args, cfg):
@@ -436,21 +477,10 @@ def step16_sysconfig(args, cfg):
 
 def step17_fstab(args, cfg):
     LOG.info(f":: Step 17: {STEPS[17]}")
-    partition = 1
     if not args.pretend:
         with open(os.path.join(os.sep, 'etc', 'fstab'), 'a') as fstab:
-            if args.parttype == "efi":
-                fstab.write(f"{cfg.get('disk')}{partition}\t/boot\tvfat\tnoatime\t1 2\n")
-                partition += 1
-
-            if args.new_world_mac:
-                partition = cfg.get("partition_start", 3)
-                fstab.write(f"{cfg.get('disk')}{partition}\t/boot\text2\tnoatime\t1 2\n")
-                partition += 1
-                fstab.write(f"{cfg.get('disk')}{partition}\tnone\tswap\tsw\t0 0\n")
-                partition += 1
-
-            fstab.write(f"{cfg.get('disk')}{partition}\t/\text4\tdefaults,noatime\t0 1\n")
+            for device, mountpoint, fstype, options, dump, fsck in gentooimgr.common.fstab_entries(args, cfg):
+                fstab.write(f"{device}\t{mountpoint}\t{fstype}\t{options}\t{dump} {fsck}\n")
 
     completestep(args, 17, "fstab")
 
@@ -535,9 +565,20 @@ def chrootfunc(args, cfg):
 
         else:
             prechroot(args, cfg)
-            gentooimgr.chroot.bind()
+            gentooimgr.chroot.bind(distfiles=getattr(args, "distfiles_cache", None))
+            if getattr(args, "binpkg_cache", None):
+                gentooimgr.binpkg.mount(args, cfg)
+            if gentooimgr.ccache.enabled(args):
+                gentooimgr.ccache.mount(args, cfg)
+            gentooimgr.tmpdir.mount(args, cfg)
+            if gentooimgr.timing.enabled(args):
+                gentooimgr.timing.mount(args, cfg)
+            if gentooimgr.kernelcache.enabled(args):
+                gentooimgr.kernelcache.mount(args, cfg)
             os.chdir(os.sep)
             os.chroot(cfg.get("mountpoint"))
+            gentooimgr.ccache.enable(args)
+            gentooimgr.jobs.apply(args)
 
         os.chdir(os.sep)
 
@@ -594,6 +635,10 @@ def configure(args, config: dict) -> int:
     if not stepdone(17): step17_fstab(args, cfg)
     if not stepdone(18): step18_passwd(args, cfg)
     # copy cloud cfg?
+    gentooimgr.ccache.report(args)
+    if getattr(args, "distfiles_cache", None) and not args.pretend:
+        # Before finalizing so the image does not ship the shared source tarballs
+        gentooimgr.chroot.unbind_distfiles()
     if not args.pretend: gentooimgr.chroot.unbind()
 
     LOG.info(":: Install process complete.")
@@ -0,0 +1,128 @@
+"""Memory-aware emerge parallelism
+
+emerge --jobs, --load-average and MAKEOPTS are derived from the cores (--threads) and the available
+memory instead of using --threads for everything:
+
+* MAKEOPTS gets as many make jobs as fit in memory at DEFAULT_JOB_MEMORY MiB each, up to the cores
+* emerge builds one package per PACKAGE_MEMORY MiB of memory in parallel, up to half the cores, and
+  --load-average keeps the combined compilers at about one per core
+* packages known to need more memory per compiler (PACKAGE_JOB_MEMORY, extended or overridden by a
+  "package_memory" {atom: MiB} config entry) get their own MAKEOPTS through package.env, sized so
+  that HEAVY_CONCURRENCY of them building at once still fit in memory
+"""
+
+import os
+import gentooimgr.config
+import gentooimgr.tmpdir
+from gentooimgr.logging import LOG
+
+# Estimated memory (MiB) of a single compiler process, per package
+PACKAGE_JOB_MEMORY = {
+    "app-portage/eix": 1024,
+    "dev-build/cmake": 1024,
+    "dev-util/cmake": 1024,
+    "dev-util/maturin": 2048,
+    "dev-python/cryptography": 2048,
+    "dev-lang/rust": 4096,
+    "dev-lang/go": 1024,
+    "dev-lang/spidermonkey": 2048,
+    "dev-libs/boost": 2048,
+    "sys-devel/gcc": 1536,
+    "sys-devel/llvm": 2048,
+    "llvm-core/llvm": 2048,
+    "llvm-core/clang": 2048,
+    "sys-kernel/gentoo-kernel": 1024,
+    "dev-qt/qtwebengine": 4096,
+    "www-client/firefox": 4096,
+}
+# Memory of a compiler process for any other package
+DEFAULT_JOB_MEMORY = 512
+# Memory set aside per package emerge builds in parallel
+PACKAGE_MEMORY = 2048
+# Heavy packages assumed to build at the same time; most parallel emerge jobs are small packages
+HEAVY_CONCURRENCY = 2
+# Kept free for the system itself
+RESERVED_MEMORY = 512
+ENV_NAME = "gentooimgr-j{jobs}.conf"
+
+
+def meminfo() -> dict:
+    """Returns the fields of /proc/meminfo in MiB"""
+    with open("/proc/meminfo", 'r') as f:
+        fields = dict(line.split(":", 1) for line in f if ":" in line)
+    return {name: int(value.split()[0]) // 1024 for name, value in fields.items()}
+
+
+def available_memory() -> int:
+    """Returns the available memory in MiB, from /proc/meminfo"""
+    try:
+        memory = meminfo()
+        return memory.get("MemAvailable", memory["MemTotal"])
+    except (OSError, KeyError, ValueError):
+        LOG.warning("\t:: Unable to read /proc/meminfo, assuming the default job memory for every core")
+        return DEFAULT_JOB_MEMORY * gentooimgr.config.THREADS
+
+
+def plan(args, memory: int = None) -> dict:
+    """Returns the make jobs, emerge jobs and load average for the cores and memory of this machine.
+
+    The memory the build tmpfs may take (gentooimgr.tmpdir.size()) is not given to compilers.
+    """
+    cores = max(1, getattr(args, "threads", None) or gentooimgr.config.THREADS)
+    memory = max(available_memory() if memory is None else memory, 0)
+    memory -= RESERVED_MEMORY + gentooimgr.tmpdir.size(args, memory=memory)
+    return {
+        "cores": cores,
+        "memory": memory,
+        "make": max(1, min(cores, memory // DEFAULT_JOB_MEMORY)),
+        "emerge": max(1, min(cores // 2, memory // PACKAGE_MEMORY)),
+        "load": cores
+    }
+
+
+def package_jobs(cfg: dict, schedule: dict) -> dict:
+    """Returns {atom: make jobs} for the memory-heavy packages that need fewer jobs than the default"""
+    estimates = dict(PACKAGE_JOB_MEMORY)
+    estimates.update(cfg.get("package_memory", {}))
+    share = schedule["memory"] // min(schedule["emerge"], HEAVY_CONCURRENCY)
+    throttled = {}
+    for atom, memory in estimates.items():
+        jobs = max(1, min(schedule["make"], share // max(memory, 1)))
+        if jobs < schedule["make"]:
+            throttled[atom] = jobs
+    return throttled
+
+
+def write_package_env(args, cfg: dict) -> dict:
+    """Write /etc/portage/env MAKEOPTS files and the package.env that assigns them to heavy packages,
+    along with the on-disk PORTAGE_TMPDIR of packages too large for the build tmpfs"""
+    schedule = plan(args)
+    throttled = package_jobs(cfg, schedule)
+    portage = os.path.join(cfg.get("mountpoint"), 'etc', 'portage')
+    os.makedirs(os.path.join(portage, 'env'), exist_ok=True)
+    for jobs in sorted(set(throttled.values())):
+        with open(os.path.join(portage, 'env', ENV_NAME.format(jobs=jobs)), 'w') as f:
+            f.write(f'MAKEOPTS="-j{jobs} -l{schedule["load"]}"\n')
+    envs = {atom: [ENV_NAME.format(jobs=jobs)] for atom, jobs in throttled.items()}
+    for atom in gentooimgr.tmpdir.write_env(args, cfg, schedule["emerge"]):
+        envs.setdefault(atom, []).append(gentooimgr.tmpdir.ENV_NAME)
+    with open(os.path.join(portage, 'package.env'), 'w') as f:
+        for atom, files in sorted(envs.items()):
+            f.write(f"{atom} {' '.join(files)}\n")
+    LOG.info(f"\t:: {schedule['cores']} cores, {schedule['memory']} MiB: MAKEOPTS -j{schedule['make']}, "
+             f"{schedule['emerge']} emerge jobs, {len(throttled)} packages throttled")
+    for atom, jobs in sorted(throttled.items()):
+        LOG.debug(f"\t:: {atom} MAKEOPTS -j{jobs}")
+    return throttled
+
+
+def apply(args) -> None:
+    """Export MAKEOPTS for every emerge of this install"""
+    schedule = plan(args)
+    os.environ["MAKEOPTS"] = f"-j{schedule['make']} -l{schedule['load']}"
+
+
+def emerge_options(args) -> list:
+    """--jobs and --load-average for emerge commands building several packages"""
+    schedule = plan(args)
+    return ["--jobs", str(schedule["emerge"]), "--load-average", str(schedule["load"])]
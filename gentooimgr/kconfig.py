@@ -0,0 +1,110 @@
+"""Kernel .config files without make
+
+A .config is read into a dict of symbol (without the CONFIG_ prefix) to value: "y", "m", "n" for
+"# CONFIG_FOO is not set" lines, or the literal value of string, int and hex options, quotes included.
+Dicts keep the order of the file, so dump() writes the options back in the order they were read.
+
+Fragments, such as kvm_guest.config or the "options" of the kernel section of a json config, are
+layered over a config with merge(), in the same way as the kernel's scripts/kconfig/merge_config.sh.
+Dependencies between symbols are not resolved here, the kernel build does that when it configures.
+"""
+
+import os
+import re
+import hashlib
+
+PREFIX = "CONFIG_"
+SET_RE = re.compile(r"^CONFIG_(\w+)=(.*)$")
+UNSET_RE = re.compile(r"^# CONFIG_(\w+) is not set$")
+
+
+def parse(text: str) -> dict:
+    """Returns {symbol: value} of the options in text, later assignments overriding earlier ones"""
+    config = {}
+    for line in text.splitlines():
+        line = line.strip()
+        m = SET_RE.match(line)
+        if m:
+            config[m.group(1)] = m.group(2)
+            continue
+        m = UNSET_RE.match(line)
+        if m:
+            config[m.group(1)] = "n"
+    return config
+
+
+def load(path: str) -> dict:
+    with open(path, 'r') as f:
+        return parse(f.read())
+
+
+def dump(config: dict) -> str:
+    lines = []
+    for symbol, value in config.items():
+        lines.append(f"# {PREFIX}{symbol} is not set" if value == "n" else f"{PREFIX}{symbol}={value}")
+    return "\n".join(lines) + "\n"
+
+
+def write(config: dict, path: str) -> None:
+    with open(path, 'w') as f:
+        f.write(dump(config))
+
+
+def options(values: dict) -> dict:
+    """Normalizes a {symbol: value} mapping from a json config: the CONFIG_ prefix is optional, true
+    and false stand for y and n, numbers are written out and other strings are quoted"""
+    config = {}
+    for symbol, value in values.items():
+        symbol = symbol[len(PREFIX):] if symbol.startswith(PREFIX) else symbol
+        if value is True or value is False:
+            value = "y" if value else "n"
+        elif isinstance(value, int):
+            value = str(value)
+        elif value not in ("y", "m", "n") and not value.startswith(('"', "0x")) and not value.lstrip("-").isdigit():
+            value = f'"{value}"'
+        config[symbol] = value
+    return config
+
+
+def merge(base: dict, *fragments: dict) -> dict:
+    """Returns base with the fragments applied in order. Overridden options keep their position,
+    new options are appended"""
+    merged = dict(base)
+    for fragment in fragments:
+        merged.update(fragment)
+    return merged
+
+
+def diff(old: dict, new: dict) -> list:
+    """Returns (symbol, old value, new value) for every option that differs, None for missing"""
+    changes = []
+    for symbol in sorted(set(old) | set(new)):
+        if old.get(symbol) != new.get(symbol):
+            changes.append((symbol, old.get(symbol), new.get(symbol)))
+    return changes
+
+
+def config_hash(config: dict) -> str:
+    """sha256 of the options, independent of their order, comments and formatting"""
+    lines = sorted(f"{symbol}={value}" for symbol, value in config.items())
+    return hashlib.sha256("\n".join(lines).encode()).hexdigest()
+
+
+def summary(config: dict) -> dict:
+    """Number of options built in, modules, disabled and with a value"""
+    counts = {"y": 0, "m": 0, "n": 0, "value": 0}
+    for value in config.values():
+        counts[value if value in counts else "value"] += 1
+    return counts
+
+
+def resolve_path(name: str, config_dir: str) -> str:
+    """Path of a .config given as a path or as the name of a file in config_dir, with or without .config"""
+    if os.path.exists(name):
+        return name
+    base = os.path.basename(name)
+    for candidate in (base, f"{os.path.splitext(base)[0]}.config"):
+        path = os.path.join(config_dir, candidate)
+        if os.path.exists(path):
+            return path
+    return None
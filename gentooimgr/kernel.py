@@ -7,10 +7,18 @@ from subprocess import Popen, PIPE
 import time
 
 import gentooimgr.configs
+import gentooimgr.ccache
+import gentooimgr.kconfig
+import gentooimgr.config
+import gentooimgr.kernelcache
+import gentooimgr.kerneltrim
 from gentooimgr.process import run_cmd
 from gentooimgr.logging import LOG
 import gentooimgr.errorcodes
 DEFAULT_KERNEL_CONFIG_PATH = os.path.join(os.sep, 'etc', 'kernel', 'default.config')
+KERNEL_BUILD_DIR = os.path.join(os.sep, 'var', 'tmp', 'gentooimgr-kernel')
+# Copy of the default config made in the source tree, kept there when it is cleaned (mrproper keeps it)
+DEFAULT_CONFIG_NAME = ".config.gentooimgr-default"
 
 def get_kernel_config_name(args, config):
     """Retrieve the expected name of our kernel .config equivalent file.
@@ -68,7 +76,11 @@ def kernel_copy_conf(args, config, inchroot=False) -> int:
         LOG.info(f"\t:: Looking for kernel configuration file {configfile}: {os.path.exists(configfile)}")
         if os.path.exists(configfile):
             LOG.debug(f"\t:: Config file {configfile} exists.")
-            shutil.copyfile(configfile, kernelconf)
+            kconfig = kernel_config(config, configfile)
+            gentooimgr.kconfig.write(kconfig, kernelconf)
+            counts = gentooimgr.kconfig.summary(kconfig)
+            LOG.info(f"\t:: Kernel configuration {kernelconf}: {counts['y']} built in, {counts['m']} modules, "
+                     f"hash {gentooimgr.kconfig.config_hash(kconfig)[:12]}")
             code = gentooimgr.errorcodes.SUCCESS
 
         else:
@@ -78,6 +90,20 @@ def kernel_copy_conf(args, config, inchroot=False) -> int:
 
     return code
 
+def kernel_config(config, configfile) -> dict:
+    """The kernel configuration of a json config: configfile with the .config files listed in the
+    kernel "fragments" and then the kernel "options" {symbol: value} applied on top"""
+    kernel = config.get("kernel", {})
+    fragments = []
+    for name in kernel.get("fragments", []):
+        path = gentooimgr.kconfig.resolve_path(name, gentooimgr.configs.CONFIG_DIR)
+        if path is None:
+            LOG.warning(f"\t:: Kernel config fragment {name} not found, skipping it")
+            continue
+        fragments.append(gentooimgr.kconfig.load(path))
+    fragments.append(gentooimgr.kconfig.options(kernel.get("options", {})))
+    return gentooimgr.kconfig.merge(gentooimgr.kconfig.load(configfile), *fragments)
+
 def chdir_kerneldir(args, inchroot=False):
     kerneldir = args.kernel_dir
     if not inchroot:
@@ -105,9 +131,27 @@ def build_kernel(args, config, inchroot=False) -> int:
     kernel_copy_conf(args, config, inchroot=inchroot)
     kernelconf = get_installed_kernel_config_path(args, config, inchroot)
     LOG.info(f"::\t Using kernel configuration {'default' if kernelconf is None else kernelconf}")
+    root = os.sep if inchroot else gentooimgr.config.GENTOO_MOUNT
+    srcdir = os.path.join(root, args.kernel_dir.lstrip(os.sep))
+    code = prepare_source_tree(args, srcdir)[0]
+    if code != gentooimgr.errorcodes.SUCCESS:
+        return code
     if kernelconf is None:
         kernel_default_config(args, config)
+        # The default config is made in the source tree, which is cleaned again for the out of tree build
+        code, kernelconf = prepare_source_tree(args, srcdir, prepared=True)
+        if code != gentooimgr.errorcodes.SUCCESS:
+            return code
+    if getattr(args, "trim", False) or config.get("kernel", {}).get("trim"):
+        if kernelconf and os.path.exists(kernelconf):
+            try:
+                gentooimgr.kerneltrim.trim_file(args, config, kernelconf, srcdir)
+            except FileNotFoundError as E:
+                LOG.error(f"\t:: {E}, building the untrimmed config")
+        else:
+            LOG.warning("\t:: No kernel configuration file to trim, building the default config untrimmed")
 
+    cc = gentooimgr.ccache.compiler(args)
     cmd = []
     has_genkernel = False
     for pkg in config.get("packages", {}).get("kernel", []):
@@ -120,18 +164,79 @@ def build_kernel(args, config, inchroot=False) -> int:
                 cmd.append( '--bootdir=/boot/efi' )
             if config.get("vga", "") == "virtio":
                 cmd.append(  '--virtio' )
-
             cmd.append("all")
-            code, stdout, stderr = run_cmd(args, cmd)
 
-    if not has_genkernel:
-        chdir_kerneldir(args)
-        shutil.copyfile(kernelconf, '.config')
-        for cmd in [['make'], ['make', 'modules_install'], ['make', 'install']]:
+    start = time.monotonic()
+    key = None
+    if gentooimgr.kernelcache.enabled(args) and kernelconf and os.path.exists(kernelconf):
+        # The compiler wrapper, jobs and build directory do not change the output, so they are not part of the key
+        key = gentooimgr.kernelcache.cache_key(kernelconf, srcdir, cmd or ["make", "install", "modules_install"])
+        if gentooimgr.kernelcache.restore(args, key, root):
+            LOG.info(f"::\t Kernel installed from cache in {time.monotonic() - start:.0f}s")
+            return code
+    since = time.time()
+
+    builddir = kernel_build_dir(args, config, srcdir, root)
+    os.makedirs(builddir, exist_ok=True)
+    LOG.info(f"::\t Building kernel in {builddir} with {args.threads} jobs")
+    jobs = [f"-j{args.threads}", f"-l{args.threads}"]
+    if has_genkernel:
+        # The build directory is kept between builds, so only what the config changes is rebuilt
+        options = [f"--kernel-outputdir={builddir}", "--no-clean", "--no-mrproper", f"--makeopts={' '.join(jobs)}"]
+        if cc:
+            options += [f'--kernel-cc={cc}', f'--utils-cc={cc}']
+        cmd = cmd[:-1] + options + cmd[-1:]
+        code, stdout, stderr = run_cmd(args, cmd)
+    else:
+        shutil.copyfile(kernelconf, os.path.join(builddir, '.config'))
+        make = ["make", "-C", srcdir, f"O={builddir}"]
+        ccargs = [f'CC={cc}', f'HOSTCC={cc}'] if cc else []
+        for cmd in [make + jobs + ccargs, make + ['modules_install'], make + ['install']]:
             code, stdout, stderr = run_cmd(args, cmd)
-
+            if code != gentooimgr.errorcodes.SUCCESS:
+                LOG.error(f"kernel command `{' '.join(cmd)}` failed")
+                break
+
+    LOG.info(f"::\t Kernel build {'finished' if code == gentooimgr.errorcodes.SUCCESS else 'failed'} "
+             f"in {time.monotonic() - start:.0f}s")
+    if code == gentooimgr.errorcodes.SUCCESS and key:
+        gentooimgr.kernelcache.store(args, key, since, root)
+    if getattr(args, "kernel_clean_build", False):
+        shutil.rmtree(builddir, ignore_errors=True)
     return code
 
+def prepare_source_tree(args, srcdir, prepared=False) -> tuple:
+    """Out of tree builds need a source tree without a .config. Returns (code, saved .config or None).
+
+    The .config is always saved first. The tree is only cleaned with mrproper if gentooimgr configured
+    it itself (prepared); a tree the user configured is left alone and the build stops.
+    """
+    dotconfig = os.path.join(srcdir, ".config")
+    if not os.path.exists(dotconfig):
+        return (gentooimgr.errorcodes.SUCCESS, None)
+    if not prepared:
+        backup = os.path.join(srcdir, f".config.gentooimgr-{time.strftime('%Y%m%d%H%M%S')}")
+        shutil.copy2(dotconfig, backup)
+        LOG.error(f"\t:: {srcdir} is configured, out of tree builds need a clean source tree. Its .config was "
+                  f"saved to {backup}, run `make -C {srcdir} mrproper` to clean it")
+        return (gentooimgr.errorcodes.PROCESS_FAILED, None)
+    saved = os.path.join(srcdir, DEFAULT_CONFIG_NAME)
+    shutil.copy2(dotconfig, saved)
+    LOG.info(f"\t:: Default kernel configuration saved to {saved}, cleaning {srcdir}")
+    code, stdout, stderr = run_cmd(args, ["make", "-C", srcdir, "mrproper"])
+    return (code, saved)
+
+def kernel_build_dir(args, config, srcdir, root=os.sep):
+    """Out of tree build directory for the kernel configuration and sources.
+
+    Build directories are kept per configuration, so a later build only compiles what changed: in
+    --kernel-cache DIR/build, otherwise in KERNEL_BUILD_DIR. --kernel-clean-build removes it after the build.
+    """
+    name = f"{get_base_config_name(args, config) or 'default'}-{os.path.basename(os.path.realpath(srcdir))}"
+    if gentooimgr.kernelcache.enabled(args):
+        return os.path.join(gentooimgr.kernelcache.cache_root(args, root), "build", name)
+    return os.path.join(root, KERNEL_BUILD_DIR.lstrip(os.sep), name)
+
 def kernel_default_config(args, config):
     code = gentooimgr.errorcodes.SUCCESS
     os.chdir(args.kernel_dir)
@@ -0,0 +1,156 @@
+"""Kernel build artifact cache
+
+With --kernel-cache DIR, DIR is bind-mounted at CACHE_DIR in the chroot. Every kernel built by step 11
+is stored in DIR/[key]: the files it installed in /boot (vmlinuz, System.map, initramfs, config) and a
+tarball of its /lib/modules directory. The key covers everything the build output depends on: the
+kernel source version, the order independent hash of the .config, the compiler and binutils versions
+and the build command. A later build with the same key installs the stored files instead of compiling.
+DIR/build keeps the out of tree build directories, so changed configurations build incrementally.
+"""
+
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import gentooimgr.download
+import gentooimgr.kconfig
+from gentooimgr.process import run, run_cmd
+from gentooimgr.logging import LOG
+
+CACHE_DIR = "/var/cache/gentooimgr-kernels"
+BOOT_DIR = "boot"
+MODULES_DIR = os.path.join("lib", "modules")
+MODULES_TAR = "modules.tar"
+MAKEFILE_VERSION_RE = re.compile(r"^(VERSION|PATCHLEVEL|SUBLEVEL|EXTRAVERSION)\s*=\s*(\S*)", re.MULTILINE)
+# Seconds subtracted from the build start, for file systems with coarse timestamps such as vfat
+MTIME_SLACK = 2
+
+
+def enabled(args) -> bool:
+    return bool(getattr(args, "kernel_cache", None))
+
+
+def mount(args, cfg: dict) -> int:
+    """Bind DIR at CACHE_DIR in the mountpoint"""
+    target = os.path.join(cfg.get("mountpoint"), CACHE_DIR.lstrip(os.sep))
+    if not args.pretend:
+        os.makedirs(args.kernel_cache, exist_ok=True)
+        os.makedirs(target, exist_ok=True)
+    code, out, err = run_cmd(args, ["mount", "--bind", str(args.kernel_cache), target])
+    if code:
+        LOG.error(f"\t:: Unable to bind kernel cache directory {args.kernel_cache}")
+    return code
+
+
+def cache_root(args, root: str) -> str:
+    """DIR as seen from root: the bind in the chroot, or DIR itself when running outside of it"""
+    bound = os.path.join(root, CACHE_DIR.lstrip(os.sep))
+    return bound if os.path.ismount(bound) else str(args.kernel_cache)
+
+
+def config_hash(path: str) -> str:
+    return gentooimgr.kconfig.config_hash(gentooimgr.kconfig.load(path))
+
+
+def source_version(kerneldir: str) -> str:
+    """Version of the kernel sources: the resolved directory name, which carries the package revision
+    (linux-6.6.30-gentoo-r1), and the version in the top Makefile"""
+    with open(os.path.join(kerneldir, "Makefile"), 'r') as f:
+        values = dict(MAKEFILE_VERSION_RE.findall(f.read(4096)))
+    version = f"{values.get('VERSION')}.{values.get('PATCHLEVEL')}.{values.get('SUBLEVEL')}{values.get('EXTRAVERSION', '')}"
+    return f"{os.path.basename(os.path.realpath(kerneldir))} {version}"
+
+
+def toolchain() -> str:
+    """Compiler and linker versions"""
+    versions = []
+    for cmd in (["gcc", "--version"], ["ld", "--version"]):
+        try:
+            code, out, err = run(cmd)
+        except OSError:
+            code, out = 1, b""
+        versions.append(out.decode(errors="replace").splitlines()[0] if not code and out else f"no {cmd[0]}")
+    return "; ".join(versions)
+
+
+def cache_key(kernelconf: str, kerneldir: str, build: list) -> dict:
+    """The key is a snapshot: build is copied, so the caller may extend its command afterwards"""
+    return {
+        "source": source_version(kerneldir),
+        "config": config_hash(kernelconf),
+        "toolchain": toolchain(),
+        "build": list(build),
+    }
+
+
+def key_digest(key: dict) -> str:
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def restore(args, key: dict, root: str = os.sep) -> bool:
+    """Install the cached build of key under root, returning False on a miss"""
+    entry = os.path.join(cache_root(args, root), key_digest(key))
+    if not os.path.exists(os.path.join(entry, "key.json")):
+        LOG.info(f"\t:: Kernel cache miss ({key['source']}, config {key['config'][:12]})")
+        return False
+    LOG.info(f"\t:: Installing kernel from cache {entry}")
+    cmds = [
+        ["cp", "-a", os.path.join(entry, BOOT_DIR) + os.sep + ".", os.path.join(root, BOOT_DIR)],
+        ["tar", "-C", root, "-xpf", os.path.join(entry, MODULES_TAR)],
+    ]
+    for cmd in cmds:
+        code, out, err = run_cmd(args, cmd)
+        if code:
+            LOG.warning("\t:: Unable to install the cached kernel, building it instead")
+            return False
+    return True
+
+
+def _changed(top: str, since: float) -> list:
+    """Paths below top, relative to it, of the files and links modified since"""
+    changed = []
+    for dirpath, dirnames, filenames in os.walk(top):
+        for name in filenames + [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]:
+            path = os.path.join(dirpath, name)
+            if os.lstat(path).st_mtime >= since:
+                changed.append(os.path.relpath(path, top))
+    return changed
+
+
+def store(args, key: dict, since: float, root: str = os.sep) -> str:
+    """Store the files the build that started at since installed in /boot and /lib/modules"""
+    since -= MTIME_SLACK
+    cache = cache_root(args, root)
+    entry = os.path.join(cache, key_digest(key))
+    boot = _changed(os.path.join(root, BOOT_DIR), since)
+    modules_dir = os.path.join(root, MODULES_DIR)
+    modules = [os.path.join(MODULES_DIR, d) for d in os.listdir(modules_dir)
+               if os.stat(os.path.join(modules_dir, d)).st_mtime >= since] if os.path.isdir(modules_dir) else []
+    if not boot:
+        LOG.warning("\t:: The kernel build installed nothing in /boot, not caching it")
+        return None
+
+    os.makedirs(cache, exist_ok=True)
+    with gentooimgr.download.artifact_lock(entry):
+        if os.path.exists(entry):
+            return entry
+        tmp = entry + ".tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        for name in boot:
+            target = os.path.join(tmp, BOOT_DIR, name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copy2(os.path.join(root, BOOT_DIR, name), target, follow_symlinks=False)
+        code, out, err = run_cmd(args, ["tar", "-C", root, "-cf", os.path.join(tmp, MODULES_TAR),
+                                        "--files-from", os.devnull] + modules)
+        if code:
+            shutil.rmtree(tmp, ignore_errors=True)
+            LOG.warning("\t:: Unable to archive the kernel modules, not caching the kernel")
+            return None
+        with open(os.path.join(tmp, "key.json"), 'w') as f:
+            json.dump(dict(key, stored=time.strftime("%Y-%m-%d %H:%M:%S"), boot=boot, modules=modules),
+                      f, indent=4, sort_keys=True)
+        os.replace(tmp, entry)
+    LOG.info(f"\t:: Kernel stored in cache {entry}: {len(boot)} boot files, {len(modules)} module directories")
+    return entry
@@ -0,0 +1,195 @@
+"""Kernel config trimming for virtio guests
+
+`kernel --trim` minimizes the kernel configuration for the guest's hardware profile (virtio devices,
+fstab file systems and CLOUD_MODULES), like `make localmodconfig`. Options defined in TRIM_DIRS or in
+the directories of unused file systems are disabled unless the profile depends on or selects them.
+"""
+
+import os
+import re
+import fnmatch
+import gentooimgr.common
+import gentooimgr.config
+import gentooimgr.kconfig
+from gentooimgr.logging import LOG
+
+VIRTIO_SYMBOLS = ["VIRTIO_MENU", "VIRTIO", "VIRTIO_PCI", "VIRTIO_BLK", "VIRTIO_NET", "VIRTIO_CONSOLE",
+                  "VIRTIO_BALLOON", "SCSI_VIRTIO", "HW_RANDOM_VIRTIO"]
+VIRTIO_GPU_SYMBOLS = ["DRM", "DRM_VIRTIO_GPU"]
+# fstab type: (directory of its Kconfig, symbols)
+FS_SYMBOLS = {
+    "ext4": ("fs/ext4", ["EXT4_FS"]),
+    "ext2": ("fs/ext2", ["EXT2_FS"]),
+    "vfat": ("fs/fat", ["VFAT_FS", "NLS_CODEPAGE_437", "NLS_ISO8859_1"]),
+    "btrfs": ("fs/btrfs", ["BTRFS_FS"]),
+    "xfs": ("fs/xfs", ["XFS_FS"]),
+    "swap": (None, ["SWAP"]),
+}
+# Driver directories a virtio guest has no hardware for. Kconfig directories are matched with fnmatch.
+TRIM_DIRS = [
+    "drivers/net/ethernet*", "drivers/net/wireless*", "drivers/net/usb*", "drivers/net/can*",
+    "drivers/net/wan*", "drivers/net/ieee802154*", "drivers/media*", "drivers/staging*",
+    "drivers/infiniband*", "drivers/isdn*", "drivers/bluetooth*", "drivers/gpu/drm/*", "drivers/hwmon*",
+    "drivers/iio*", "drivers/mtd*", "drivers/nfc*", "drivers/platform*", "drivers/input/joystick*",
+    "drivers/input/touchscreen*", "drivers/input/tablet*", "drivers/power/supply*", "drivers/leds*",
+    "drivers/usb/serial*", "drivers/usb/misc*", "drivers/usb/gadget*", "sound*",
+]
+# File system directories trimmed unless the fstab mounts them. isofs stays for cloud config drives.
+FS_DIRS = [
+    "fs/btrfs", "fs/xfs", "fs/jfs", "fs/reiserfs", "fs/gfs2", "fs/ocfs2", "fs/nilfs2", "fs/f2fs", "fs/hfs",
+    "fs/hfsplus", "fs/befs", "fs/affs", "fs/adfs", "fs/bfs", "fs/efs", "fs/cramfs", "fs/freevxfs",
+    "fs/minix", "fs/omfs", "fs/hpfs", "fs/qnx4", "fs/qnx6", "fs/romfs", "fs/sysv", "fs/ufs", "fs/erofs",
+    "fs/ntfs", "fs/ntfs3", "fs/orangefs", "fs/ceph", "fs/coda", "fs/ecryptfs", "fs/jffs2", "fs/ubifs",
+    "fs/udf", "fs/zonefs", "fs/exfat", "fs/ext2", "fs/fat",
+]
+CONFIG_RE = re.compile(r"^(?:menu)?config\s+(\w+)")
+DEPENDS_RE = re.compile(r"^depends\s+on\s+(.*)")
+SELECT_RE = re.compile(r"^select\s+(\w+)")
+IF_RE = re.compile(r"^if\s+(.*)")
+SYMBOL_RE = re.compile(r"\b[A-Z][A-Z0-9_]+\b")
+OBJ_RE = re.compile(r"^obj-\$\(CONFIG_(\w+)\)\s*[+:]?=\s*(.*)$", re.MULTILINE)
+
+
+def parse_kconfig(srcdir: str) -> dict:
+    """Returns {symbol: (Kconfig directory relative to srcdir, symbols it depends on or selects)} of
+    every Kconfig file in srcdir. Conditions of enclosing if and menu blocks count as dependencies."""
+    symbols = {}
+    for dirpath, dirnames, filenames in os.walk(srcdir):
+        dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+        relative = os.path.relpath(dirpath, srcdir)
+        for name in filenames:
+            if name == "Kconfig" or name.startswith("Kconfig."):
+                _parse_kconfig_file(os.path.join(dirpath, name), relative, symbols)
+    return symbols
+
+
+def _parse_kconfig_file(path: str, relative: str, symbols: dict) -> None:
+    blocks = []
+    current = None
+    help_indent = None
+    with open(path, 'r', errors="replace") as f:
+        for raw in f:
+            line = raw.expandtabs(8)
+            stripped = line.strip()
+            indent = len(line) - len(line.lstrip())
+            if help_indent is not None:
+                if not stripped or indent > help_indent:
+                    continue
+                help_indent = None
+            if not stripped or stripped.startswith("#"):
+                continue
+            m = CONFIG_RE.match(stripped)
+            if m:
+                current = m.group(1)
+                deps = symbols.setdefault(current, (relative, set()))[1]
+                for block in blocks:
+                    deps.update(block)
+                continue
+            if stripped in ("help", "---help---"):
+                help_indent = indent
+            elif stripped.startswith(("menu ", "choice")):
+                blocks.append(set())
+                current = blocks[-1]
+            elif stripped in ("endmenu", "endchoice", "endif"):
+                if blocks:
+                    blocks.pop()
+                current = None
+            elif IF_RE.match(stripped):
+                blocks.append(set(SYMBOL_RE.findall(IF_RE.match(stripped).group(1))))
+                current = None
+            elif DEPENDS_RE.match(stripped) and current is not None:
+                found = SYMBOL_RE.findall(DEPENDS_RE.match(stripped).group(1))
+                (current if isinstance(current, set) else symbols[current][1]).update(found)
+            elif SELECT_RE.match(stripped) and isinstance(current, str):
+                symbols[current][1].add(SELECT_RE.match(stripped).group(1))
+
+
+def module_symbols(srcdir: str) -> dict:
+    """Returns {module name: symbol} from the obj-$(CONFIG_FOO) += foo.o lines of the kernel Makefiles"""
+    modules = {}
+    for dirpath, dirnames, filenames in os.walk(srcdir):
+        dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+        for name in filenames:
+            if name in ("Makefile", "Kbuild"):
+                with open(os.path.join(dirpath, name), 'r', errors="replace") as f:
+                    for symbol, objects in OBJ_RE.findall(f.read()):
+                        for obj in objects.split():
+                            if obj.endswith(".o"):
+                                modules.setdefault(obj[:-2].replace("-", "_"), symbol)
+    return modules
+
+
+def profile(args, config: dict, modules: dict) -> dict:
+    """Returns {symbol: value} of the options the guest needs"""
+    wanted = {symbol: "y" for symbol in VIRTIO_SYMBOLS}
+    if config.get("vga") == "virtio":
+        wanted.update({symbol: "y" for symbol in VIRTIO_GPU_SYMBOLS})
+    for device, mountpoint, fstype, options, dump, fsck in gentooimgr.common.fstab_entries(args, config):
+        wanted.update({symbol: "y" for symbol in FS_SYMBOLS.get(fstype, (None, []))[1]})
+    for module in gentooimgr.config.CLOUD_MODULES:
+        symbol = modules.get(module.replace("-", "_"))
+        if symbol is None:
+            LOG.warning(f"\t:: No kernel option builds module {module}, it is not part of the trimmed config")
+            continue
+        wanted[symbol] = "m"
+    return wanted
+
+
+def mounted_dirs(args, config: dict) -> set:
+    """Kconfig directories of the file systems in the guest's fstab"""
+    return {FS_SYMBOLS[entry[2]][0] for entry in gentooimgr.common.fstab_entries(args, config)
+            if entry[2] in FS_SYMBOLS and FS_SYMBOLS[entry[2]][0]}
+
+
+def closure(symbols: dict, wanted) -> set:
+    """wanted and every symbol they depend on or select, recursively"""
+    keep = set()
+    pending = list(wanted)
+    while pending:
+        symbol = pending.pop()
+        if symbol in keep:
+            continue
+        keep.add(symbol)
+        pending.extend(symbols.get(symbol, ("", set()))[1])
+    return keep
+
+
+def trim(args, config: dict, kconfig: dict, srcdir: str) -> tuple:
+    """Returns (trimmed kconfig, symbols disabled, symbols enabled)"""
+    symbols = parse_kconfig(srcdir)
+    if not symbols:
+        raise FileNotFoundError(f"No Kconfig files in {srcdir}, kernel sources are needed to trim the config")
+    wanted = profile(args, config, module_symbols(srcdir))
+    keep = closure(symbols, wanted)
+    mounted = mounted_dirs(args, config)
+    patterns = TRIM_DIRS + [f"{d}*" for d in FS_DIRS if d not in mounted]
+
+    trimmed = dict(kconfig)
+    disabled = []
+    for symbol, value in kconfig.items():
+        if value not in ("y", "m") or symbol in keep or symbol not in symbols:
+            continue
+        if any(fnmatch.fnmatch(symbols[symbol][0], pattern) for pattern in patterns):
+            trimmed[symbol] = "n"
+            disabled.append(symbol)
+    enabled = []
+    for symbol, value in wanted.items():
+        # Symbols this kernel version does not have are skipped, ie: VIRTIO_MENU before 5.6
+        if symbol in symbols and trimmed.get(symbol) not in ("y", "m"):
+            trimmed[symbol] = value
+            enabled.append(symbol)
+    return (trimmed, disabled, enabled)
+
+
+def trim_file(args, config: dict, path: str, srcdir: str) -> int:
+    """Trim the .config at path in place, returning how many options were disabled"""
+    kconfig = gentooimgr.kconfig.load(path)
+    trimmed, disabled, enabled = trim(args, config, kconfig, srcdir)
+    gentooimgr.kconfig.write(trimmed, path)
+    before, after = gentooimgr.kconfig.summary(kconfig), gentooimgr.kconfig.summary(trimmed)
+    LOG.info(f"\t:: Trimmed kernel config {path}: {len(disabled)} options removed, {len(enabled)} enabled "
+             f"({before['y']} -> {after['y']} built in, {before['m']} -> {after['m']} modules)")
+    LOG.debug(f"\t:: Removed: {' '.join(disabled)}")
+    if enabled:
+        LOG.info(f"\t:: Enabled for the guest profile: {' '.join(enabled)}")
+    return len(disabled)
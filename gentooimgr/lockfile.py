@@ -0,0 +1,150 @@
+"""Pinned artifact lockfile
+
+`python -m gentooimgr lock` records the exact iso, stage3 and dated portage snapshot (name, url, size
+and digests) in a json lockfile. While it exists, build and install use exactly those artifacts, and
+a lockfile of another architecture or profile raises LockfileMismatch.
+"""
+
+import os
+import json
+import time
+import datetime
+from urllib.request import urlopen
+from urllib.error import HTTPError
+import gentooimgr.config
+import gentooimgr.download as download
+import gentooimgr.errorcodes
+from gentooimgr.logging import LOG
+
+LOCKFILE = "gentooimgr.lock"
+# Digest recorded for files that have no verified digests yet (portage)
+LOCK_DIGEST = "sha512"
+COMPONENTS = ("iso", "stage3", "portage")
+# Days before the local portage file's date searched for the dated snapshot it matches
+SNAPSHOT_LOOKBACK = 3
+
+
+class LockfileMismatch(Exception):
+    """Raised when the lockfile pins artifacts of another architecture or profile than the build"""
+
+
+def build_target(args, config: dict) -> dict:
+    """Architecture and profile of the stage3 a build with args and config uses"""
+    return {
+        "architecture": download.stage3_config(config).ARCHITECTURE,
+        "profile": download.stage3_profile(args, config)
+    }
+
+
+def lockfile_path(args) -> str:
+    return str(getattr(args, "lockfile", None) or os.path.join(args.download_dir, LOCKFILE))
+
+
+def load(args, config: dict = None) -> dict:
+    """Returns the lockfile contents, or None if there is no lockfile.
+
+    With config, the pinned architecture and profile must be the ones of the build, otherwise
+    LockfileMismatch is raised.
+    """
+    path = lockfile_path(args)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        locked = json.load(f)
+    if config is not None:
+        target = build_target(args, config)
+        # Lockfiles of openrc builds may have no profile recorded
+        pinned = {"architecture": locked.get("architecture"), "profile": locked.get("profile") or "openrc"}
+        for key, value in target.items():
+            if pinned[key] != value:
+                raise LockfileMismatch(f"{path} pins {key} {pinned[key]} but this build uses {value}, "
+                                       "run `lock` again or use another --lockfile")
+    LOG.info(f"\t:: Using pinned artifacts from {path}")
+    return locked
+
+
+def _entry(args, path: str, url: str) -> dict:
+    digests = download.verified_digests(args, path)
+    if not digests:
+        digests = download.hash_file(path, [LOCK_DIGEST])
+        download.record_verified(args, path, digests)
+    return {
+        "name": os.path.basename(path),
+        "url": url,
+        "size": os.path.getsize(path),
+        "digests": digests
+    }
+
+
+def dated_portage_url(args, path: str, url: str) -> str:
+    """Url of the dated snapshot the portage file at path is a copy of.
+
+    portage-latest is a copy of the newest dated snapshot, which is usually from the day before the
+    local file's date. The md5sum files of SNAPSHOT_LOOKBACK days are compared with the file's md5.
+    """
+    md5 = download.hash_file(path, ["md5"])["md5"]
+    base = os.path.basename(url)
+    day = datetime.datetime.fromtimestamp(os.path.getmtime(path), datetime.timezone.utc).date()
+    for delta in range(-1, SNAPSHOT_LOOKBACK + 1):
+        name = base.replace("latest", (day - datetime.timedelta(days=delta)).strftime("%Y%m%d"))
+        candidate = os.path.join(os.path.dirname(url), name)
+        try:
+            with urlopen(candidate + ".md5sum", timeout=download.TIMEOUT) as response:
+                content = response.read().decode(errors="replace")
+        except HTTPError as hE:
+            if hE.code == 404:
+                continue
+            raise
+        if md5 in content.lower().split():
+            LOG.debug(f"\t:: {os.path.basename(path)} is {name}")
+            return candidate
+    raise download.DownloadError(f"{os.path.basename(path)} matches none of the dated snapshots of the "
+                                 f"{SNAPSHOT_LOOKBACK + 2} days around {day}, download it again with --redownload")
+
+
+def lock(args, config: dict) -> int:
+    """Download the current artifacts and write the lockfile that pins them"""
+    c = gentooimgr.config.config(config.get("architecture", "amd64"))
+    target = build_target(args, config)
+    iso = download.download(args, c)
+    stage3 = download.download_stage3(args, cfg=config, profile=target["profile"])
+    portage = download.download_portage(args, cfg=config)
+
+    s3c = download.stage3_config(config)
+    stage3base = s3c.GENTOO_BASE_STAGE_SYSTEMD_URL if target["profile"] == "systemd" else s3c.GENTOO_BASE_STAGE_OPENRC_URL
+    portageurl = dated_portage_url(args, portage, download.latest_portage(args, cfg=config)[0])
+    locked = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        **target,
+        "iso": _entry(args, iso, os.path.join(c.GENTOO_BASE_ISO_URL, os.path.basename(iso))),
+        "stage3": _entry(args, stage3, os.path.join(stage3base, os.path.basename(stage3))),
+        "portage": _entry(args, portage, portageurl)
+    }
+
+    path = lockfile_path(args)
+    with open(path + ".tmp", 'w') as f:
+        json.dump(locked, f, indent=4, sort_keys=True)
+    os.replace(path + ".tmp", path)
+    for name in COMPONENTS:
+        LOG.info(f"\t:: Pinned {name} {locked[name]['name']} ({locked[name]['size']} bytes)")
+    print(f"Wrote {path}")
+    return gentooimgr.errorcodes.SUCCESS
+
+
+def resolve(args, entry: dict, progress=None) -> str:
+    """Returns the local path of a pinned artifact, downloading it from its recorded url if needed.
+
+    Local files must match the recorded size and digests; unchanged files already verified are not rehashed.
+    """
+    path = os.path.join(args.download_dir, entry["name"])
+    expected = entry["digests"]
+    if not os.path.exists(path):
+        return download.fetch_artifact(args, entry["url"], path, entry["size"], expected, entry["name"],
+                                       progress=progress)
+
+    size = os.path.getsize(path)
+    assert size == entry["size"], f"{entry['name']} size {size} does not match pinned value {entry['size']}."
+    if not download.is_verified(args, path, expected):
+        if download.check_digests(args, expected, download.hash_file(path, expected), entry["name"]):
+            download.record_verified(args, path, expected)
+    return path
@@ -0,0 +1,88 @@
+"""Mirror selection for downloads
+
+gentooimgr.config.config() always builds distfiles.gentoo.org urls. When mirrors are set, with
+--mirror or the "mirrors" list in a json config, those urls are rewritten to the same path on each
+mirror in order of measured speed. Mirrors are ranked by probing a small byte range of the portage
+snapshot: the time to the response headers is the latency and the rate of the body is the throughput.
+The ranking is cached in the download directory for --mirror-cache-hours.
+"""
+
+import os
+import json
+import time
+from urllib.parse import urlparse
+from urllib.request import urlopen, Request
+from concurrent.futures import ThreadPoolExecutor
+from gentooimgr.logging import LOG
+
+# Hosts that gentooimgr.config.config() urls point to and that can be substituted with a mirror
+DEFAULT_MIRROR_HOSTS = ["distfiles.gentoo.org"]
+# File and amount of it read from each mirror to measure it
+PROBE_PATH = "snapshots/portage-latest.tar.xz"
+PROBE_BYTES = 256 * 1024
+PROBE_TIMEOUT = 5
+RANKING_CACHE = ".gentooimgr-mirrors.json"
+
+
+def probe(mirror: str, timeout=PROBE_TIMEOUT) -> tuple:
+    """Returns (latency in seconds, throughput in bytes per second) of mirror, or None if it failed"""
+    url = mirror.rstrip("/") + "/" + PROBE_PATH
+    try:
+        start = time.monotonic()
+        with urlopen(Request(url, headers={"Range": f"bytes=0-{PROBE_BYTES - 1}"}), timeout=timeout) as response:
+            latency = time.monotonic() - start
+            received = len(response.read(PROBE_BYTES))
+            elapsed = max(time.monotonic() - start - latency, 1e-6)
+    except OSError as E:
+        LOG.debug(f"\t:: Mirror {mirror} probe failed: {E}")
+        return None
+    return (latency, received / elapsed)
+
+
+def rank(args, mirrors: list) -> list:
+    """Order mirrors fastest first, reusing the cached ranking if it is recent and for the same mirrors.
+
+    Mirrors are sorted by the estimated time to fetch PROBE_BYTES (latency + size / throughput).
+    Unreachable mirrors are kept at the end so they are still tried as a last resort.
+    """
+    cache = os.path.join(args.download_dir, RANKING_CACHE)
+    maxage = getattr(args, "mirror_cache_hours", 24) * 60 * 60
+    try:
+        with open(cache, 'r') as f:
+            cached = json.load(f)
+        if sorted(cached.get("mirrors", [])) == sorted(mirrors) and time.time() - cached.get("time", 0) < maxage:
+            return cached["ranked"]
+    except (OSError, ValueError):
+        pass
+
+    with ThreadPoolExecutor(max_workers=len(mirrors) or 1) as pool:
+        results = dict(zip(mirrors, pool.map(probe, mirrors)))
+
+    def cost(mirror):
+        result = results[mirror]
+        if result is None:
+            return float("inf")
+        latency, throughput = result
+        return latency + PROBE_BYTES / max(throughput, 1)
+
+    ranked = sorted(mirrors, key=cost)
+    for mirror in ranked:
+        result = results[mirror]
+        LOG.info(f"\t:: Mirror {mirror}: " + ("unreachable" if result is None else
+                 f"{result[0] * 1000:.0f} ms, {result[1] / 1024:.0f} KiB/s"))
+    with open(cache, 'w') as f:
+        json.dump({"mirrors": mirrors, "ranked": ranked, "time": time.time()}, f, indent=4)
+    return ranked
+
+
+def candidates(args, url: str) -> list:
+    """Returns url rewritten to every configured mirror, fastest first.
+
+    urls that are not on a default mirror host, or runs without mirrors set, only get [url].
+    """
+    mirrors = getattr(args, "mirrors", None)
+    parsed = urlparse(url)
+    if not mirrors or parsed.hostname not in DEFAULT_MIRROR_HOSTS:
+        return [url]
+
+    return [mirror.rstrip("/") + parsed.path for mirror in rank(args, list(mirrors))]
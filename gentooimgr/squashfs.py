@@ -0,0 +1,104 @@
+"""Portage tree from a cached squashfs image
+
+With --portage-squashfs DIR, step 5 converts the portage snapshot once into DIR/[sha512].squashfs and
+loop-mounts it read-only instead of extracting hundreds of thousands of files into the image. A tmpfs
+backed overlay on top takes the writes of `emerge --sync` and emerge itself, so none of the tree ends
+up in the image: all mounts live under the mountpoint and `unchroot` removes them with the binds.
+
+The image is built with tar2sqfs (squashfs-tools-ng) straight from the tarball when it is installed,
+otherwise the snapshot is extracted to a temporary directory and packed with mksquashfs.
+"""
+
+import os
+import shutil
+import gentooimgr.download
+import gentooimgr.extract
+from gentooimgr.process import run_cmd
+from gentooimgr.logging import LOG
+
+SQUASHFS_DIGEST = "sha512"
+# Where the tree is mounted in the guest; the default location in gentoo's repos.conf
+REPO_PATH = os.path.join("var", "db", "repos", "gentoo")
+# Holds the read-only squashfs mount and the tmpfs with the overlay upper and work directories
+MOUNT_BASE = os.path.join("var", "cache", "gentooimgr-portage")
+# Top level directory of gentoo portage snapshots
+SNAPSHOT_ROOT = "portage"
+COMPRESSION = "zstd"
+
+
+def available() -> bool:
+    return bool(shutil.which("tar2sqfs") or shutil.which("mksquashfs"))
+
+
+def ensure_image(args, snapshot: str, cache: str) -> str:
+    """Returns the squashfs image of the snapshot in cache, building it first if needed"""
+    snapshot = os.path.abspath(str(snapshot))
+    image = os.path.join(str(cache), gentooimgr.download.file_digest(args, snapshot, SQUASHFS_DIGEST) + ".squashfs")
+    if args.pretend:
+        LOG.info(f"PRETEND use portage squashfs image {image}")
+        return image
+    os.makedirs(str(cache), exist_ok=True)
+    with gentooimgr.download.artifact_lock(image):
+        if os.path.exists(image):
+            LOG.info(f"\t:: Using cached portage squashfs image {image}")
+            return image
+
+        LOG.info(f"\t:: Creating portage squashfs image {image}")
+        tmp = image + ".tmp"
+        if shutil.which("tar2sqfs"):
+            code = _tar2sqfs(args, snapshot, tmp)
+        else:
+            code = _mksquashfs(args, snapshot, tmp)
+        if code:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise RuntimeError(f"Unable to create a squashfs image of {snapshot}")
+        os.replace(tmp, image)
+    return image
+
+
+def _tar2sqfs(args, snapshot: str, image: str) -> int:
+    decoder = gentooimgr.extract.decoder(snapshot, args.threads)
+    with open(snapshot, 'rb') as f:
+        code, out, err = run_cmd(args, ["sh", "-c", f"{decoder} -d | tar2sqfs --quiet --force --compressor {COMPRESSION} "
+                                        f"--num-jobs {args.threads} --root-becomes {SNAPSHOT_ROOT} {image}"], stdin=f)
+    return code
+
+
+def _mksquashfs(args, snapshot: str, image: str) -> int:
+    tree = image + ".d"
+    shutil.rmtree(tree, ignore_errors=True)
+    os.makedirs(tree)
+    try:
+        code = gentooimgr.extract.extract(args, snapshot, tree)
+        if not code:
+            code, out, err = run_cmd(args, ["mksquashfs", os.path.join(tree, SNAPSHOT_ROOT), image, "-noappend",
+                                            "-quiet", "-comp", COMPRESSION, "-processors", str(args.threads)])
+    finally:
+        shutil.rmtree(tree, ignore_errors=True)
+    return code
+
+
+def mount(args, image: str, mountpoint: str) -> int:
+    """Mount the image read-only with a tmpfs overlay on top at REPO_PATH in the mountpoint"""
+    base = os.path.join(mountpoint, MOUNT_BASE)
+    lower = os.path.join(base, "lower")
+    rw = os.path.join(base, "rw")
+    target = os.path.join(mountpoint, REPO_PATH)
+    if not args.pretend:
+        for d in (lower, rw, target):
+            os.makedirs(d, exist_ok=True)
+    mounts = [
+        ["mount", "-t", "squashfs", "-o", "loop,ro", image, lower],
+        ["mount", "-t", "tmpfs", "gentooimgr-portage", rw],
+        ["mkdir", "-p", os.path.join(rw, "upper"), os.path.join(rw, "work")],
+        ["mount", "-t", "overlay", "gentooimgr-portage", "-o",
+         f"lowerdir={lower},upperdir={os.path.join(rw, 'upper')},workdir={os.path.join(rw, 'work')}", target],
+    ]
+    for cmd in mounts:
+        code, out, err = run_cmd(args, cmd)
+        if code:
+            LOG.error(f"\t:: {' '.join(cmd)} failed")
+            return code
+    LOG.info(f"\t:: Portage tree mounted from {image} at /{REPO_PATH}")
+    return 0
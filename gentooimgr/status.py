@@ -1,6 +1,9 @@
 import json
 import gentooimgr.config
 import gentooimgr.configs
+import gentooimgr.kconfig
+import gentooimgr.kernel
+import gentooimgr.timing
 
 def print_template(args, configjson):
     print(f"""------------------------ STATUS ------------------------
@@ -12,6 +15,9 @@ PROFILE = {args.profile}
     print(f"CONFIG {args.config}")
     print(json.dumps(configjson, sort_keys=True, indent=4))
     print(gentooimgr.config.config(configjson.get("architecture", "amd64")))
+    print_kernel_config(args, configjson)
+    if gentooimgr.timing.enabled(args):
+        gentooimgr.timing.report(args, configjson)
 
     # inherit = configjson.get("inherit")
     # if inherit:
@@ -27,3 +33,30 @@ PROFILE = {args.profile}
     #     print(k.upper())
     #     print("\t" + '\n\t'.join(v))
     #     print()
+
+
+def print_kernel_config(args, configjson):
+    """Summary of the kernel configuration that would be installed, and its differences with
+    --kernel-diff"""
+    name = gentooimgr.kernel.get_base_config_name(args, configjson)
+    path = gentooimgr.kconfig.resolve_path(name, gentooimgr.configs.CONFIG_DIR) if name else None
+    if path is None:
+        print("KERNEL CONFIG default (make defconfig)")
+        return
+    kconfig = gentooimgr.kernel.kernel_config(configjson, path)
+    counts = gentooimgr.kconfig.summary(kconfig)
+    print(f"KERNEL CONFIG {path}")
+    print(f"\t{counts['y']} built in, {counts['m']} modules, {counts['n']} not set, {counts['value']} values")
+    print(f"\thash {gentooimgr.kconfig.config_hash(kconfig)}")
+
+    other = getattr(args, "kernel_diff", None)
+    if not other:
+        return
+    otherpath = gentooimgr.kconfig.resolve_path(str(other), gentooimgr.configs.CONFIG_DIR)
+    if otherpath is None:
+        print(f"KERNEL CONFIG DIFF {other} not found")
+        return
+    changes = gentooimgr.kconfig.diff(kconfig, gentooimgr.kconfig.load(otherpath))
+    print(f"KERNEL CONFIG DIFF {path} -> {otherpath}: {len(changes)} options")
+    for symbol, old, new in changes:
+        print(f"\t{gentooimgr.kconfig.PREFIX}{symbol}: {old or '-'} -> {new or '-'}")
@@ -0,0 +1,222 @@
+"""Package build times and ETAs
+
+With --build-times DIR, how long each package took to merge is read from /var/log/emerge.log
+after the emerges of steps 9 and 10 and kept in DIR/buildtimes.json. DIR is bind-mounted at
+DB_DIR in the chroot so the times outlive the image. Times are stored per architecture and core
+count, then per category/package and version, keeping the last HISTORY merges of each version.
+
+While emerge runs, the log is followed to report how much time is left, from the stored times of
+the remaining packages or, for packages never built before, the average of this run. `status`
+lists the slowest packages, and duration() gives estimates to anything else that needs them.
+"""
+
+import os
+import re
+import json
+import statistics
+import threading
+import contextlib
+import gentooimgr.common
+import gentooimgr.download
+import gentooimgr.jobs
+from gentooimgr.process import run_cmd
+from gentooimgr.logging import LOG
+
+DB_DIR = "/var/cache/gentooimgr-buildtimes"
+DB_NAME = "buildtimes.json"
+EMERGE_LOG = "/var/log/emerge.log"
+# Merges kept per package version
+HISTORY = 5
+# Seconds between reads of the emerge log while following it
+POLL = 10
+START_RE = re.compile(r"^(\d+):\s+>>> emerge \((\d+) of (\d+)\) (\S+?)(?:::\S+)? to ", re.MULTILINE)
+DONE_RE = re.compile(r"^(\d+):\s+::: completed emerge \((\d+) of (\d+)\) (\S+?)(?:::\S+)? to ", re.MULTILINE)
+
+# Size of the emerge log when it was last read, so merges are only recorded once
+_log_offset = None
+
+
+def enabled(args) -> bool:
+    return bool(getattr(args, "build_times", None))
+
+
+def db_key(args, cfg: dict) -> str:
+    return f"{cfg.get('architecture', 'amd64')}-{gentooimgr.jobs.plan(args)['cores']}"
+
+
+def db_path(args) -> str:
+    """Path of the database, inside the chroot once it is bound there"""
+    directory = DB_DIR if os.path.isdir(DB_DIR) and os.path.ismount(DB_DIR) else str(args.build_times)
+    return os.path.join(directory, DB_NAME)
+
+
+def load(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def mount(args, cfg: dict) -> int:
+    """Bind DIR at DB_DIR in the mountpoint"""
+    global _log_offset
+    target = os.path.join(cfg.get("mountpoint"), DB_DIR.lstrip(os.sep))
+    if not args.pretend:
+        os.makedirs(args.build_times, exist_ok=True)
+        os.makedirs(target, exist_ok=True)
+    code, out, err = run_cmd(args, ["mount", "--bind", str(args.build_times), target])
+    if code:
+        LOG.error(f"\t:: Unable to bind build times directory {args.build_times}")
+        return code
+    log = os.path.join(cfg.get("mountpoint"), EMERGE_LOG.lstrip(os.sep))
+    _log_offset = os.path.getsize(log) if os.path.exists(log) else 0
+    return 0
+
+
+def _events(content: str) -> list:
+    """Returns (timestamp, completed, category/package-version, n, of) of the merges started and
+    completed in content, in log order"""
+    events = [(m.start(), m, False) for m in START_RE.finditer(content)]
+    events += [(m.start(), m, True) for m in DONE_RE.finditer(content)]
+    return [(int(m.group(1)), done, m.group(4), int(m.group(2)), int(m.group(3)))
+            for pos, m, done in sorted(events, key=lambda e: e[0])]
+
+
+def parse_log(content: str) -> list:
+    """Returns (category/package-version, seconds) of every merge completed in content"""
+    started = {}
+    merged = []
+    for timestamp, done, cpv, n, total in _events(content):
+        if not done:
+            started[cpv] = timestamp
+        elif cpv in started:
+            merged.append((cpv, timestamp - started.pop(cpv)))
+    return merged
+
+
+def record(args, cfg: dict) -> int:
+    """Add the merges logged since the last call to the database, returning how many there were"""
+    global _log_offset
+    if not enabled(args) or args.pretend or not os.path.exists(EMERGE_LOG):
+        return 0
+    with open(EMERGE_LOG, 'r', errors="replace") as f:
+        f.seek(_log_offset or 0)
+        content = f.read()
+        _log_offset = f.tell()
+    merged = parse_log(content)
+    if not merged:
+        return 0
+    path = db_path(args)
+    with gentooimgr.download.artifact_lock(path, verbose=False):
+        db = load(path)
+        packages = db.setdefault(db_key(args, cfg), {})
+        for cpv, seconds in merged:
+            package, version = gentooimgr.common.split_cpv(cpv)
+            times = packages.setdefault(package, {}).setdefault(version or "", [])
+            times[:] = (times + [seconds])[-HISTORY:]
+        with open(path + ".tmp", 'w') as f:
+            json.dump(db, f, indent=4, sort_keys=True)
+        os.replace(path + ".tmp", path)
+    LOG.info(f"\t:: Recorded build times of {len(merged)} packages")
+    return len(merged)
+
+
+def duration(args, cfg: dict, cpv: str, db: dict = None) -> float:
+    """Expected seconds to merge cpv (category/package or category/package-version), None if it
+    was never built on this architecture and core count. The median of the merges of the same
+    version is used, or of every version if that one was not built before."""
+    if db is None:
+        db = load(db_path(args)) if enabled(args) else {}
+    package, version = gentooimgr.common.split_cpv(cpv)
+    versions = db.get(db_key(args, cfg), {}).get(package)
+    if not versions:
+        return None
+    times = versions.get(version or "") or [t for merges in versions.values() for t in merges]
+    return statistics.median(times)
+
+
+def eta(args, cfg: dict, cpvs: list, db: dict = None) -> tuple:
+    """Returns (expected seconds, packages without a build time) to merge cpvs, with emerge
+    building several packages at once"""
+    if db is None:
+        db = load(db_path(args)) if enabled(args) else {}
+    known = [duration(args, cfg, cpv, db) for cpv in cpvs]
+    parallel = gentooimgr.jobs.plan(args)["emerge"]
+    return (sum(t for t in known if t is not None) / parallel, sum(1 for t in known if t is None))
+
+
+def _format(seconds: float) -> str:
+    minutes = int(seconds) // 60
+    return f"{minutes // 60}h{minutes % 60:02d}m" if minutes >= 60 else f"{minutes}m{int(seconds) % 60:02d}s"
+
+
+@contextlib.contextmanager
+def watch(args, cfg: dict, cpvs: list = None):
+    """Log the time left while the block runs emerge, following the emerge log in a thread.
+
+    cpvs are the packages that will be merged, when known.
+    """
+    if not enabled(args) or args.pretend or not os.path.exists(EMERGE_LOG):
+        yield
+        return
+    db = load(db_path(args))
+    if cpvs:
+        seconds, unknown = eta(args, cfg, cpvs, db)
+        LOG.info(f"\t:: {len(cpvs)} packages, about {_format(seconds)}"
+                 + (f" plus {unknown} packages never built before" if unknown else ""))
+    stop = threading.Event()
+
+    def follow(offset):
+        parallel = gentooimgr.jobs.plan(args)["emerge"]
+        remaining = list(cpvs or [])
+        started = {}
+        taken = []
+        while not stop.wait(POLL):
+            with open(EMERGE_LOG, 'rb') as f:
+                f.seek(offset)
+                content = f.read()
+            # Only complete lines, the rest is read again next time
+            content = content[:content.rfind(b"\n") + 1]
+            offset += len(content)
+            for timestamp, done, cpv, n, total in _events(content.decode(errors="replace")):
+                if not done:
+                    started[cpv] = timestamp
+                    continue
+                if cpv in started:
+                    taken.append(timestamp - started.pop(cpv))
+                if cpv in remaining:
+                    remaining.remove(cpv)
+                average = statistics.mean(taken) if taken else 0
+                if remaining:
+                    known = [duration(args, cfg, c, db) for c in remaining]
+                    left = sum(t if t is not None else average for t in known)
+                else:
+                    left = (total - n) * average
+                LOG.info(f"\t:: ({n} of {total}) {cpv} merged, about {_format(left / parallel)} left")
+
+    thread = threading.Thread(target=follow, args=(os.path.getsize(EMERGE_LOG),), daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def slowest(args, cfg: dict, count: int = 20) -> list:
+    """Returns (seconds, category/package, version) of the count slowest packages, with the
+    slowest version of each"""
+    packages = load(db_path(args)).get(db_key(args, cfg), {})
+    times = [max((statistics.median(merges), package, version) for version, merges in versions.items())
+             for package, versions in packages.items() if versions]
+    return sorted(times, reverse=True)[:count]
+
+
+def report(args, cfg: dict, count: int = 20) -> None:
+    """Print the slowest packages for `status`"""
+    slow = slowest(args, cfg, count)
+    print(f"BUILD TIMES {db_path(args)} ({db_key(args, cfg)})")
+    if not slow:
+        print("\tNo packages recorded")
+    for seconds, package, version in slow:
+        print(f"\t{_format(seconds):>8}  {package}-{version}" if version else f"\t{_format(seconds):>8}  {package}")
@@ -0,0 +1,126 @@
+"""Package builds in RAM
+
+Before chrooting, a tmpfs is mounted over the guest's /var/tmp/portage, where emerge unpacks and
+compiles every package, so builds do not write to the image's disk. The files never reach the image
+and nothing has to be sparsified away afterwards.
+
+The tmpfs may use half of the available memory, which jobs.plan() leaves out of the memory it
+schedules compilers in, as it only takes memory for what is stored in it. Packages whose
+build directory is estimated to be larger than their share of it (PACKAGE_BUILD_SPACE, extended or
+overridden by a "package_build_space" {atom: MiB} config entry) are built on disk in DISK_TMPDIR
+through package.env. Builds stay on disk altogether with --no-tmpfs, when there is less than
+MIN_TMPFS of RAM to spare, or when the tmpfs cannot be mounted.
+"""
+
+import os
+import gentooimgr.chroot
+import gentooimgr.jobs
+from gentooimgr.process import run_cmd
+from gentooimgr.logging import LOG
+
+# emerge builds in PORTAGE_TMPDIR/portage, PORTAGE_TMPDIR being /var/tmp by default
+TMPFS_DIR = os.path.join("var", "tmp", "portage")
+DISK_TMPDIR = "/var/tmp/notmpfs"
+ENV_NAME = "gentooimgr-notmpfs.conf"
+# Device name of the tmpfs, telling it apart from tmpfs mounts that are not ours
+MOUNT_SOURCE = "gentooimgr-tmpdir"
+# Estimated size (MiB) of the build directory of large packages
+PACKAGE_BUILD_SPACE = {
+    "sys-devel/gcc": 6144,
+    "sys-devel/llvm": 6144,
+    "llvm-core/llvm": 6144,
+    "llvm-core/clang": 8192,
+    "dev-lang/rust": 12288,
+    "dev-lang/go": 2048,
+    "dev-lang/spidermonkey": 4096,
+    "dev-libs/boost": 3072,
+    "sys-kernel/gentoo-kernel": 6144,
+    "sys-kernel/linux-firmware": 2048,
+    "dev-qt/qtwebengine": 16384,
+    "www-client/firefox": 12288,
+}
+# Part of the RAM the tmpfs may use: 1 / TMPFS_FRACTION
+TMPFS_FRACTION = 2
+MIN_TMPFS = 4096
+
+
+def enabled(args) -> bool:
+    return not getattr(args, "no_tmpfs", False)
+
+
+def mounted_size(target: str) -> int:
+    """Size in MiB of the build tmpfs mounted at target, None if it is not mounted there"""
+    try:
+        with open("/proc/self/mounts", 'r') as f:
+            mounted = any(line.split()[:2] == [MOUNT_SOURCE, os.path.abspath(target)] for line in f)
+    except OSError:
+        return None
+    if not mounted:
+        return None
+    st = os.statvfs(target)
+    return (st.f_blocks * st.f_frsize) >> 20
+
+
+def size(args, root: str = os.sep, memory: int = None) -> int:
+    """Size of the tmpfs in MiB, 0 if builds stay on disk.
+
+    Once the tmpfs is mounted under root, this is the size it was mounted with, so the steps run in
+    the chroot agree on it. Until then it is sized from memory, the available memory by default.
+    """
+    if not enabled(args):
+        return 0
+    mounted = mounted_size(os.path.join(root, TMPFS_DIR))
+    if mounted is not None:
+        return mounted
+    memory = gentooimgr.jobs.available_memory() if memory is None else memory
+    tmpfs = (memory - gentooimgr.jobs.RESERVED_MEMORY) // TMPFS_FRACTION
+    return tmpfs if tmpfs >= MIN_TMPFS else 0
+
+
+def disk_packages(cfg: dict, tmpfs: int, parallel: int) -> list:
+    """Returns the atoms that do not fit in the tmpfs next to parallel other builds"""
+    estimates = dict(PACKAGE_BUILD_SPACE)
+    estimates.update(cfg.get("package_build_space", {}))
+    share = tmpfs // max(1, min(parallel, gentooimgr.jobs.HEAVY_CONCURRENCY))
+    return sorted(atom for atom, space in estimates.items() if space > share)
+
+
+def write_env(args, cfg: dict, parallel: int) -> list:
+    """Write the env file building on disk and return the atoms that need it in package.env"""
+    tmpfs = size(args, cfg.get("mountpoint"))
+    if not tmpfs:
+        return []
+    mountpoint = cfg.get("mountpoint")
+    disk = os.path.join(mountpoint, DISK_TMPDIR.lstrip(os.sep))
+    os.makedirs(os.path.join(disk, "portage"), exist_ok=True)
+    uid, gid = gentooimgr.chroot.portage_ids(mountpoint)
+    for d in (disk, os.path.join(disk, "portage")):
+        os.chown(d, uid, gid)
+        os.chmod(d, 0o775)
+    with open(os.path.join(mountpoint, 'etc', 'portage', 'env', ENV_NAME), 'w') as f:
+        f.write(f'PORTAGE_TMPDIR="{DISK_TMPDIR}"\n')
+    atoms = disk_packages(cfg, tmpfs, parallel)
+    LOG.info(f"\t:: {tmpfs} MiB tmpfs for builds, {len(atoms)} large packages built on disk")
+    return atoms
+
+
+def mount(args, cfg: dict) -> int:
+    """Mount the tmpfs over the guest's build directory, leaving builds on disk if that fails"""
+    mountpoint = cfg.get("mountpoint")
+    target = os.path.join(mountpoint, TMPFS_DIR)
+    if os.path.ismount(target):
+        return 0
+    tmpfs = size(args)
+    if not tmpfs:
+        LOG.info("\t:: Building packages on disk")
+        return 0
+    uid, gid = gentooimgr.chroot.portage_ids(mountpoint)
+    if not args.pretend:
+        os.makedirs(target, exist_ok=True)
+    code, out, err = run_cmd(args, ["mount", "-t", "tmpfs", "-o", f"size={tmpfs}M,mode=775,uid={uid},gid={gid}",
+                                    MOUNT_SOURCE, target])
+    if code:
+        LOG.warning(f"\t:: Unable to mount a tmpfs at {target}, building packages on disk")
+        return code
+    LOG.info(f"\t:: Building packages in a {tmpfs} MiB tmpfs")
+    return 0
@@ -0,0 +1,77 @@
+"""Eviction order, size parsing and protected artifacts of the download directory cleaner"""
+
+import os
+import argparse
+import pytest
+import gentooimgr.config
+import gentooimgr.clean as clean
+
+DAY = gentooimgr.config.DAY_IN_SECONDS
+NOW = 1000 * DAY
+
+
+def entry(path, days_ago, size=100):
+    return (NOW - days_ago * DAY, size, path)
+
+
+FILES = [
+    entry("/d/stage3-amd64-openrc-1.tar.xz", 10),
+    entry("/d/stage3-amd64-openrc-1.tar.xz.sha256", 10, size=1),
+    entry("/d/portage-20240101.tar.xz", 3),
+    entry("/d/install-amd64-minimal-1.iso", 1),
+    entry("/d/install-amd64-minimal-2.iso.part", 20),
+]
+
+
+def paths(evict):
+    return [path for used, size, path in evict]
+
+
+def test_parse_size():
+    assert clean.parse_size("512") == 512
+    assert clean.parse_size("4K") == 4096
+    assert clean.parse_size("1.5G") == 3 << 29
+    assert clean.parse_size("20gib") == 20 << 30
+    with pytest.raises(ValueError):
+        clean.parse_size("lots")
+
+
+def test_select_evicts_least_recently_used_first_within_budget():
+    evict = clean.select(FILES, set(), budget=201, now=NOW)
+    assert paths(evict) == ["/d/install-amd64-minimal-2.iso.part", "/d/stage3-amd64-openrc-1.tar.xz.sha256",
+                            "/d/stage3-amd64-openrc-1.tar.xz"]
+
+
+def test_select_max_age_only_removes_expired_files():
+    evict = clean.select(FILES, set(), max_age=5, now=NOW)
+    assert sorted(paths(evict)) == ["/d/install-amd64-minimal-2.iso.part", "/d/stage3-amd64-openrc-1.tar.xz",
+                                    "/d/stage3-amd64-openrc-1.tar.xz.sha256"]
+
+
+def test_select_max_age_and_budget():
+    evict = clean.select(FILES, set(), budget=100, max_age=15, now=NOW)
+    assert paths(evict)[0] == "/d/install-amd64-minimal-2.iso.part"
+    assert paths(evict)[-1] == "/d/portage-20240101.tar.xz"
+
+
+def test_select_without_options_evicts_everything_unprotected():
+    evict = clean.select(FILES, {"portage-20240101.tar.xz"}, now=NOW)
+    assert "/d/portage-20240101.tar.xz" not in paths(evict)
+    assert len(evict) == len(FILES) - 1
+
+
+def test_select_keeps_siblings_of_protected_artifacts():
+    protected = {"stage3-amd64-openrc-1.tar.xz", "install-amd64-minimal-2.iso"}
+    evict = clean.select(FILES, protected, budget=0, now=NOW)
+    assert paths(evict) == ["/d/portage-20240101.tar.xz", "/d/install-amd64-minimal-1.iso"]
+
+
+def test_protected_names_follow_latest_files(tmp_path):
+    with open(tmp_path / "latest-stage3-amd64-systemd.txt", 'w') as f:
+        f.write("Hash: SHA512\n\nstage3-amd64-systemd-2.tar.xz 123456\n")
+    args = argparse.Namespace(download_dir=str(tmp_path), profile="systemd", lockfile=None, iso=None,
+                              stage3=None, portage=None)
+    names = clean.protected_names(args, {"architecture": "amd64", "portage": "/elsewhere/portage-1.tar.xz"})
+    assert names == {"latest-install-amd64-minimal.txt", "latest-stage3-amd64-systemd.txt",
+                     "stage3-amd64-systemd-2.tar.xz", "portage-1.tar.xz"}
+    assert clean.artifact_name("stage3-amd64-systemd-2.tar.xz.part.segments") == "stage3-amd64-systemd-2.tar.xz"
@@ -0,0 +1,271 @@
+"""Downloads against a local HTTP server: resume, servers without range support, conditional
+requests and mirror failover"""
+
+import os
+import re
+import json
+import time
+import hashlib
+import argparse
+import threading
+import http.server
+import pytest
+import gentooimgr.download as download
+import gentooimgr.mirrors as mirrors
+
+
+class Mirror(http.server.ThreadingHTTPServer):
+    """Serves files from a dict of path to bytes, recording the requests it gets.
+
+    ranges: honour Range headers; fail: answer every request with this status;
+    cut: close the connection after this many body bytes; stall: then wait this many seconds first.
+    """
+    daemon_threads = True
+
+    def __init__(self, files):
+        super().__init__(("127.0.0.1", 0), MirrorHandler)
+        self.files = files
+        self.etags = {}
+        self.ranges = True
+        self.fail = None
+        self.cut = None
+        self.stall = 0
+        self.requests = []
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+
+class MirrorHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, dict(self.headers)))
+        if server.fail:
+            self.send_error(server.fail)
+            return
+        data = server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        etag = server.etags.get(self.path, f'"{hashlib.md5(data).hexdigest()}"')
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        start, status = 0, 200
+        m = re.match(r"bytes=(\d+)-$", self.headers.get("Range", ""))
+        if m and server.ranges and self.headers.get("If-Range") in (None, etag):
+            start, status = int(m.group(1)), 206
+            if start >= len(data):
+                self.send_error(416)
+                return
+        body = data[start:]
+        self.send_response(status)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if server.cut is not None:
+            self.wfile.write(body[:server.cut])
+            self.wfile.flush()
+            time.sleep(server.stall)
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(files):
+        server = Mirror(files)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def args(tmp_path):
+    return argparse.Namespace(download_dir=str(tmp_path), redownload=False, force=False, days=7, mirrors=None,
+                              connections=None, mirror_cache_hours=24)
+
+
+def payload(size=300 * 1024):
+    return os.urandom(size)
+
+
+def use_mirrors(args, servers):
+    """Set the mirrors in the given order without probing them"""
+    args.mirrors = [server.url for server in servers]
+    with open(os.path.join(args.download_dir, mirrors.RANKING_CACHE), 'w') as f:
+        json.dump({"mirrors": args.mirrors, "ranked": args.mirrors, "time": time.time()}, f)
+
+
+def test_fetch_resumes_interrupted_download(serve, tmp_path):
+    data = payload()
+    server = serve({"/file": data})
+    server.cut = 100 * 1024
+    target = str(tmp_path / "file")
+    with pytest.raises(Exception):
+        download.fetch(server.url + "/file", target, size=len(data))
+    assert not os.path.exists(target)
+    assert os.path.getsize(target + ".part") == 100 * 1024
+
+    server.cut = None
+    digests = {"sha256": hashlib.sha256(data).hexdigest()}
+    download.fetch(server.url + "/file", target, size=len(data), digests=digests,
+                   check=lambda part, computed: download.check_digests(argparse.Namespace(force=False), digests,
+                                                                       computed, "file"))
+    with open(target, 'rb') as f:
+        assert f.read() == data
+    headers = server.requests[-1][1]
+    assert headers["Range"] == f"bytes={100 * 1024}-"
+    assert headers["If-Range"] == f'"{hashlib.md5(data).hexdigest()}"'
+    assert not os.path.exists(target + ".part")
+    assert not os.path.exists(target + ".part.validator")
+
+
+def test_fetch_restarts_when_server_ignores_range(serve, tmp_path):
+    data = payload()
+    server = serve({"/file": data})
+    server.ranges = False
+    target = str(tmp_path / "file")
+    with open(target + ".part", 'wb') as f:
+        f.write(b"x" * 1000)
+
+    download.fetch(server.url + "/file", target, size=len(data))
+    with open(target, 'rb') as f:
+        assert f.read() == data
+    assert server.requests[-1][1]["Range"] == "bytes=1000-"
+
+
+def test_fetch_restarts_when_file_changed_upstream(serve, tmp_path):
+    old, new = payload(), payload()
+    server = serve({"/file": old})
+    server.cut = 1000
+    target = str(tmp_path / "file")
+    with pytest.raises(Exception):
+        download.fetch(server.url + "/file", target)
+
+    server.cut = None
+    server.files["/file"] = new
+    download.fetch(server.url + "/file", target)
+    with open(target, 'rb') as f:
+        assert f.read() == new
+
+
+def test_fetch_metadata_revalidates_with_304(serve, args):
+    server = serve({"/latest.txt": b"first\n"})
+    target = os.path.join(args.download_dir, "latest.txt")
+    download.fetch_metadata(args, server.url + "/latest.txt", target)
+    assert "If-None-Match" not in server.requests[-1][1]
+
+    download.fetch_metadata(args, server.url + "/latest.txt", target)
+    assert server.requests[-1][1]["If-None-Match"] == '"%s"' % hashlib.md5(b"first\n").hexdigest()
+    with open(target, 'rb') as f:
+        assert f.read() == b"first\n"
+
+    server.files["/latest.txt"] = b"second\n"
+    download.fetch_metadata(args, server.url + "/latest.txt", target)
+    with open(target, 'rb') as f:
+        assert f.read() == b"second\n"
+
+
+def test_fetch_metadata_uses_cached_copy_when_offline(serve, args):
+    server = serve({"/latest.txt": b"first\n"})
+    target = os.path.join(args.download_dir, "latest.txt")
+    download.fetch_metadata(args, server.url + "/latest.txt", target)
+    server.fail = 503
+    download.fetch_metadata(args, server.url + "/latest.txt", target)
+    with open(target, 'rb') as f:
+        assert f.read() == b"first\n"
+
+
+def artifact(args, data, path="/releases/file.iso"):
+    """fetch_artifact() of data from distfiles.gentoo.org, which the mirrors stand in for"""
+    digests = {"sha512": hashlib.sha512(data).hexdigest()}
+    fullpath = os.path.join(args.download_dir, os.path.basename(path))
+    return download.fetch_artifact(args, "https://distfiles.gentoo.org" + path, fullpath, len(data), digests,
+                                   os.path.basename(path), progress=lambda *a: None)
+
+
+def test_failover_on_error(serve, args):
+    data = payload()
+    broken, good = serve({}), serve({"/releases/file.iso": data})
+    broken.fail = 500
+    use_mirrors(args, [broken, good])
+
+    with open(artifact(args, data), 'rb') as f:
+        assert f.read() == data
+    assert broken.requests and good.requests
+
+
+def test_failover_on_stall_resumes_from_next_mirror(serve, args, monkeypatch):
+    monkeypatch.setattr(download, "TIMEOUT", 0.5)
+    data = payload()
+    stalled, good = serve({"/releases/file.iso": data}), serve({"/releases/file.iso": data})
+    stalled.cut, stalled.stall = 64 * 1024, 3
+    use_mirrors(args, [stalled, good])
+
+    with open(artifact(args, data), 'rb') as f:
+        assert f.read() == data
+    assert good.requests[-1][1]["Range"] == f"bytes={64 * 1024}-"
+
+
+def test_failover_after_hash_mismatch(serve, args):
+    data = payload()
+    corrupt, good = serve({"/releases/file.iso": payload(len(data))}), serve({"/releases/file.iso": data})
+    use_mirrors(args, [corrupt, good])
+
+    with open(artifact(args, data), 'rb') as f:
+        assert f.read() == data
+    assert "Range" not in good.requests[-1][1]
+
+
+def test_segmented_part_is_not_complete_for_single_connection(serve, args, monkeypatch):
+    monkeypatch.setattr(download, "SEGMENT_SIZE", 64 * 1024)
+    data = payload()
+    server = serve({"/releases/file.iso": data})
+    use_mirrors(args, [server])
+    fullpath = os.path.join(args.download_dir, "file.iso")
+    with open(fullpath + ".part", 'wb') as f:
+        f.truncate(len(data))
+        f.write(data[:64 * 1024])
+    download._save_segments(fullpath + ".part.segments", len(data), {0})
+
+    with open(artifact(args, data), 'rb') as f:
+        assert f.read() == data
+    assert server.requests[0][1]["Range"] == f"bytes={64 * 1024}-{2 * 64 * 1024 - 1}"
+    assert not os.path.exists(fullpath + ".part.segments")
+
+
+def test_portage_failover_on_error(serve, args):
+    data = payload()
+    broken, good = serve({}), serve({"/snapshots/portage-latest.tar.xz": data})
+    broken.fail = 404
+    use_mirrors(args, [broken, good])
+
+    path = download.download_portage(args, cfg={"architecture": "amd64"}, progress=lambda *a: None)
+    with open(path, 'rb') as f:
+        assert f.read() == data
+
+
+def test_portage_digests(serve, args):
+    data = payload()
+    md5 = hashlib.md5(data).hexdigest()
+    server = serve({"/snapshots/portage-latest.tar.xz.md5sum": f"{md5}  portage-latest.tar.xz\n".encode()})
+    assert download.portage_digests(args, server.url + "/snapshots/portage-latest.tar.xz") == {"md5": md5}
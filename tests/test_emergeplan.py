@@ -0,0 +1,45 @@
+"""Atom parsing and filtering of the step 10 emerge plan"""
+
+import gentooimgr.emergeplan as emergeplan
+
+PLAN = """
+These are the packages that would be merged, in order:
+
+[ebuild  N     ] app-editors/vim-9.0.1000-r1::gentoo  USE="acl -X" 12,345 KiB
+[binary   R    ] dev-lang/python-3.11.4:3.11::gentoo
+[ebuild     U  ] sys-kernel/gentoo-sources-6.6.1 [6.6.0]
+[uninstall     ] app-misc/removed-1.0
+"""
+
+
+def test_split_atom():
+    assert emergeplan.split_atom("app-editors/vim") == ("app-editors", "vim")
+    assert emergeplan.split_atom("vim") == (None, "vim")
+    assert emergeplan.split_atom(">=dev-lang/python-3.11.4-r1") == ("dev-lang", "python")
+    assert emergeplan.split_atom("=sys-kernel/gentoo-sources-6.6*") == ("sys-kernel", "gentoo-sources")
+    assert emergeplan.split_atom("dev-lang/python:3.11") == ("dev-lang", "python")
+    assert emergeplan.split_atom("<app-misc/foo-1.0[bar]") == ("app-misc", "foo")
+    # Without an operator a trailing number is part of the name
+    assert emergeplan.split_atom("sys-devel/gcc-13") == ("sys-devel", "gcc-13")
+
+
+def test_parse_plan():
+    assert emergeplan.parse_plan(PLAN) == ["app-editors/vim-9.0.1000-r1", "dev-lang/python-3.11.4",
+                                           "sys-kernel/gentoo-sources-6.6.1"]
+    assert emergeplan.parse_plan("") == []
+
+
+def test_pending():
+    merges = emergeplan.parse_plan(PLAN)
+    assert emergeplan.pending("app-editors/vim", merges)
+    assert emergeplan.pending("vim", merges)
+    assert emergeplan.pending(">=dev-lang/python-3.11", merges)
+    assert not emergeplan.pending("app-misc/vim", merges)
+    assert not emergeplan.pending("app-portage/eix", merges)
+    assert not emergeplan.pending("app-misc/removed", merges)
+
+
+def test_pending_keeps_sets_and_unparseable_atoms():
+    assert emergeplan.pending("@world", [])
+    assert emergeplan.pending("@system", ["app-editors/vim-9.0"])
+    assert emergeplan.pending("%not-an-atom", [])
@@ -0,0 +1,60 @@
+"""Streamed extraction into a destination that already has files"""
+
+import io
+import os
+import tarfile
+import hashlib
+import argparse
+import pytest
+import gentooimgr.extract as extract
+
+
+def archive(tmp_path, files) -> tuple:
+    """A .tar.gz of files (name to bytes) and its sha256 digests"""
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    path = tmp_path / "archive.tar.gz"
+    path.write_bytes(buf.getvalue())
+    return path.as_uri(), {"sha256": hashlib.sha256(buf.getvalue()).hexdigest()}
+
+
+@pytest.fixture
+def dest(tmp_path):
+    dest = tmp_path / "dest"
+    (dest / "portage").mkdir(parents=True)
+    (dest / "portage" / "old").write_text("old")
+    (dest / "portage" / "kept").write_text("kept")
+    return dest
+
+
+@pytest.fixture
+def args():
+    return argparse.Namespace(pretend=False, force=False, mirrors=None)
+
+
+def test_stream_extract_merges_into_dest(tmp_path, dest, args):
+    url, digests = archive(tmp_path, {"portage/old": b"new", "portage/added": b"added"})
+    extract.stream_extract(args, url, str(dest), expected=digests)
+    assert (dest / "portage" / "old").read_text() == "new"
+    assert (dest / "portage" / "added").read_text() == "added"
+    assert (dest / "portage" / "kept").read_text() == "kept"
+    assert sorted(os.listdir(dest)) == ["portage"]
+
+
+def test_stream_extract_mismatch_leaves_dest_unchanged(tmp_path, dest, args):
+    url, digests = archive(tmp_path, {"portage/old": b"new", "portage/added": b"added"})
+    with pytest.raises(AssertionError):
+        extract.stream_extract(args, url, str(dest), expected={"sha256": "0" * 64})
+    assert (dest / "portage" / "old").read_text() == "old"
+    assert sorted(os.listdir(dest / "portage")) == ["kept", "old"]
+    assert sorted(os.listdir(dest)) == ["portage"]
+
+
+def test_stream_extract_requires_digests(tmp_path, dest, args):
+    url, digests = archive(tmp_path, {"portage/old": b"new"})
+    with pytest.raises(ValueError):
+        extract.stream_extract(args, url, str(dest))
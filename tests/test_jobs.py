@@ -0,0 +1,20 @@
+"""Memory planning of emerge jobs next to the build tmpfs"""
+
+import argparse
+import gentooimgr.jobs as jobs
+import gentooimgr.tmpdir as tmpdir
+
+
+def test_tmpfs_size_from_memory():
+    args = argparse.Namespace()
+    assert tmpdir.size(args, memory=32768) == (32768 - jobs.RESERVED_MEMORY) // tmpdir.TMPFS_FRACTION
+    assert tmpdir.size(args, memory=tmpdir.MIN_TMPFS) == 0
+    assert tmpdir.size(argparse.Namespace(no_tmpfs=True), memory=32768) == 0
+
+
+def test_plan_leaves_out_tmpfs():
+    args = argparse.Namespace(threads=16)
+    tmpfs = tmpdir.size(args, memory=32768)
+    assert jobs.plan(args, memory=32768)["memory"] == 32768 - jobs.RESERVED_MEMORY - tmpfs
+    assert jobs.plan(argparse.Namespace(threads=16, no_tmpfs=True), memory=32768)["memory"] == \
+        32768 - jobs.RESERVED_MEMORY
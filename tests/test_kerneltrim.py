@@ -0,0 +1,144 @@
+"""Kconfig parsing, dependency closure and trimming on a small kernel source tree"""
+
+import argparse
+import textwrap
+import pytest
+import gentooimgr.config
+import gentooimgr.kerneltrim as kerneltrim
+
+TREE = {
+    "Kconfig": """
+        config NET
+        \tbool "Networking"
+
+        menu "Device drivers"
+        \tdepends on HAS_IOMEM
+
+        config VIRTIO
+        \ttristate
+        \thelp
+        \t  config NOT_A_SYMBOL is help text
+        \t  depends on HELP_TEXT
+
+        endmenu
+
+        config HAS_IOMEM
+        \tdef_bool y
+    """,
+    "drivers/virtio/Kconfig": """
+        menuconfig VIRTIO_MENU
+        \tbool "Virtio drivers"
+
+        if VIRTIO_MENU
+
+        config VIRTIO_PCI
+        \ttristate "PCI driver for virtio devices"
+        \tdepends on PCI && !UML
+        \tselect VIRTIO
+
+        endif
+
+        config VIRTIO_BALLOON
+        \ttristate
+        \tdepends on VIRTIO
+    """,
+    "drivers/net/ethernet/intel/Kconfig": """
+        config E1000
+        \ttristate "Intel PRO/1000"
+        \tdepends on PCI
+    """,
+    "drivers/net/ethernet/Kconfig": """
+        config NET_VENDOR_INTEL
+        \tbool
+        \tdepends on NET
+    """,
+    "drivers/scsi/Kconfig": """
+        config ISCSI_TCP
+        \ttristate "iSCSI Initiator over TCP/IP"
+        \tdepends on NET
+    """,
+    "drivers/scsi/Makefile": """
+        obj-$(CONFIG_ISCSI_TCP)\t+= iscsi_tcp.o
+        obj-$(CONFIG_SCSI) += scsi_mod.o
+    """,
+    "fs/ext4/Kconfig": """
+        config EXT4_FS
+        \ttristate "Ext4"
+    """,
+    "fs/xfs/Kconfig": """
+        config XFS_FS
+        \ttristate "XFS"
+    """,
+}
+
+
+@pytest.fixture
+def srcdir(tmp_path):
+    for path, content in TREE.items():
+        target = tmp_path / path
+        target.parent.mkdir(parents=True, exist_ok=True)
+        target.write_text(textwrap.dedent(content).lstrip())
+    return str(tmp_path)
+
+
+@pytest.fixture
+def args():
+    return argparse.Namespace(parttype="bios", new_world_mac=False)
+
+
+def test_parse_kconfig_directories(srcdir):
+    symbols = kerneltrim.parse_kconfig(srcdir)
+    assert symbols["E1000"][0] == "drivers/net/ethernet/intel"
+    assert symbols["VIRTIO_MENU"][0] == "drivers/virtio"
+    assert symbols["NET"][0] == "."
+
+
+def test_parse_kconfig_menu_and_if_blocks(srcdir):
+    symbols = kerneltrim.parse_kconfig(srcdir)
+    # depends on of a menu applies to every config inside it
+    assert "HAS_IOMEM" in symbols["VIRTIO"][1]
+    assert "HAS_IOMEM" not in symbols["NET"][1]
+    # the condition of an if block is a dependency of its configs, and ends with endif
+    assert symbols["VIRTIO_PCI"][1] == {"VIRTIO_MENU", "PCI", "UML", "VIRTIO"}
+    assert symbols["VIRTIO_BALLOON"][1] == {"VIRTIO"}
+
+
+def test_parse_kconfig_skips_help_text(srcdir):
+    symbols = kerneltrim.parse_kconfig(srcdir)
+    assert "NOT_A_SYMBOL" not in symbols
+    assert "HELP_TEXT" not in symbols["VIRTIO"][1]
+
+
+def test_module_symbols(srcdir):
+    assert kerneltrim.module_symbols(srcdir) == {"iscsi_tcp": "ISCSI_TCP", "scsi_mod": "SCSI"}
+
+
+def test_closure_follows_dependencies_and_selects(srcdir):
+    symbols = kerneltrim.parse_kconfig(srcdir)
+    assert kerneltrim.closure(symbols, ["VIRTIO_PCI"]) == {"VIRTIO_PCI", "VIRTIO_MENU", "PCI", "UML", "VIRTIO",
+                                                           "HAS_IOMEM"}
+    # symbols without a Kconfig entry end the walk
+    assert kerneltrim.closure(symbols, ["UNKNOWN"]) == {"UNKNOWN"}
+
+
+def test_trim(srcdir, args, monkeypatch):
+    monkeypatch.setattr(gentooimgr.config, "CLOUD_MODULES", ["iscsi_tcp"])
+    kconfig = {"NET": "y", "NET_VENDOR_INTEL": "y", "E1000": "m", "XFS_FS": "m", "EXT4_FS": "n", "VIRTIO": "y",
+               "LOCALVERSION": '""'}
+    trimmed, disabled, enabled = kerneltrim.trim(args, {"disk": "/dev/vda"}, kconfig, srcdir)
+
+    # drivers of TRIM_DIRS and file systems the fstab does not mount are disabled
+    assert sorted(disabled) == ["E1000", "NET_VENDOR_INTEL", "XFS_FS"]
+    # the profile is enabled, ext4 from the fstab and iscsi_tcp as a module
+    assert trimmed["EXT4_FS"] == "y"
+    assert trimmed["ISCSI_TCP"] == "m"
+    assert trimmed["VIRTIO_PCI"] == "y"
+    # profile symbols missing from these sources are not added
+    assert "SCSI_VIRTIO" not in trimmed
+    assert "VIRTIO" not in enabled
+    assert trimmed["NET"] == "y" and trimmed["LOCALVERSION"] == '""'
+
+
+def test_trim_without_sources(tmp_path, args):
+    with pytest.raises(FileNotFoundError):
+        kerneltrim.trim(args, {}, {}, str(tmp_path))